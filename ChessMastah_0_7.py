@@ -1,5 +1,15 @@
 #!/usr/bin/env python3
-import os,sys,random,subprocess,cProfile
+import os,sys,random,subprocess,cProfile,pstats,argparse,time,json,multiprocessing
+import re,collections,itertools,mmap,struct,array,math
+import asyncio,threading,concurrent.futures,weakref,pickle,signal
+from collections.abc import MutableMapping
+from multiprocessing import shared_memory
+
+# NumPy is only needed to tune the evaluation
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Chessmastah, Jan 2012 by Svein Arne Roed,
 # updated for Python 3 oct 2018 (>=3.6)
@@ -8,8 +18,8 @@ import os,sys,random,subprocess,cProfile
 # 
 # New in version 07:
 # * Python 3
-# * self.validmoves now updated once per turn per player, instead of calculated for every potential move,
-#   this saves on average 180k function calls to player.canmoveto()
+# * self.validmoves now updated once per turn per player, instead of calculated for every potential move
+#   (moves now come from precomputed move tables, see pseudomoves)
 # * random computer will try to capture opponent if possible(small step up from pure random)
 #
 # Features :
@@ -27,16 +37,83 @@ import os,sys,random,subprocess,cProfile
 # for constructive feedback.
 
 
-class Player():
+# Move tables, computed once at import. Squares are (row, col) like the
+# keys of Game.board, row 0 is white's back rank.
+
+ROOKDIRS   = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+BISHOPDIRS = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+KNIGHTDIRS = [(2, 1), (2, -1), (-2, 1), (-2, -1),
+              (1, 2), (1, -2), (-1, 2), (-1, -2)]
+PAWNDIRS   = {'white': 1, 'black': -1}
+PROMOTIONS = ['q', 'kn', 'r', 'b']
+
+def onboard(row, col):
+    return 0 <= row < 8 and 0 <= col < 8
+
+def jumps(square, dirs):
+    return tuple((square[0]+dr, square[1]+dc) for dr, dc in dirs
+                 if onboard(square[0]+dr, square[1]+dc))
+
+def ray(square, direction):
+    row, col = square
+    squares = []
+    while onboard(row+direction[0], col+direction[1]):
+        row, col = row+direction[0], col+direction[1]
+        squares.append((row, col))
+    return tuple(squares)
+
+ALLSQUARES  = [(x, y) for x in range(8) for y in range(8)]
+KNIGHTJUMPS = {sq: jumps(sq, KNIGHTDIRS) for sq in ALLSQUARES}
+KINGSTEPS   = {sq: jumps(sq, ROOKDIRS + BISHOPDIRS) for sq in ALLSQUARES}
+
+# Sliding rays per direction, empty rays left out
+ROOKRAYS   = {sq: tuple(r for r in (ray(sq, d) for d in ROOKDIRS) if r)
+              for sq in ALLSQUARES}
+BISHOPRAYS = {sq: tuple(r for r in (ray(sq, d) for d in BISHOPDIRS) if r)
+              for sq in ALLSQUARES}
+QUEENRAYS  = {sq: ROOKRAYS[sq] + BISHOPRAYS[sq] for sq in ALLSQUARES}
+SLIDERRAYS = {'r': ROOKRAYS, 'b': BISHOPRAYS, 'q': QUEENRAYS}
+
+# Every ray from a square, with the sliders that attack along it
+SLIDERLINES = {sq: tuple((squares, ('r', 'q')) for squares in ROOKRAYS[sq]) +
+                   tuple((squares, ('b', 'q')) for squares in BISHOPRAYS[sq])
+               for sq in ALLSQUARES}
+
+# Squares strictly between two squares on a common line
+BETWEEN = {(sq, squares[index]): frozenset(squares[:index])
+           for sq in ALLSQUARES for squares in QUEENRAYS[sq]
+           for index in range(len(squares))}
+
+# Pawn pushes are (one step, two steps), captures are the forward diagonals
+PAWNPUSHES   = {colour: {sq: ray(sq, (step, 0))[:2] for sq in ALLSQUARES}
+                for colour, step in PAWNDIRS.items()}
+PAWNCAPTURES = {colour: {sq: jumps(sq, [(step, 1), (step, -1)])
+                         for sq in ALLSQUARES}
+                for colour, step in PAWNDIRS.items()}
+
 
-    allsquares = [(x, y) for x in range(8) for y in range(8)]
-    dullmoves = 0
+class Player():
 
-    def __init__(self, colour, nature, name):
+    def __init__(self, colour, nature, name, seed=None,
+                 movetime=None, maxnodes=None, maxdepth=None, hashmb=16,
+                 book=None, threads=1):
 
         self.colour   = colour
         self.nature   = nature
         self.name     = name
+        self.random   = random.Random(seed)
+        # Search budget of the AI, without one it plays random captures
+        self.movetime = movetime
+        self.maxnodes = maxnodes
+        self.maxdepth = maxdepth
+        # Transposition table size, the table is made by the first search
+        self.hashmb   = hashmb
+        self.table    = None
+        # Searching processes, more than one searches with a ParallelSearch
+        self.threads  = threads
+        self.parallel = None
+        # Opening book file the AI plays from while it knows the position
+        self.book     = openbook(book) if book else None
         self.can_castle_long_this_turn  = False
         self.can_castle_short_this_turn = False
         self.playedturns = 0
@@ -52,25 +129,231 @@ class Player():
         self.opponent = opponent
 
     def getpieces(self, board):
+        if isinstance(board, BitBoard):
+            return board.positions(board.occupied[self.colour])
         return [pos for pos in board if board[pos].colour is self.colour]
 
-    def potentialtargets(self, playerspieces):
-        return [pos for pos in self.allsquares if pos not in playerspieces]
-
     def kingpos(self, board):
-        for mine in self.getpieces(board):
-            if board[mine].piecename is 'k':
-                return mine
+        return board.kings.get(self.colour)
 
-    def get_validmoves(self, board):
+    def get_validmoves(self, board, moves=None):
+        """ The legal ones of moves, by default of all pseudomoves """
+
+        COUNTERS['get_validmoves'] += 1
         self.set_castling_flags(board)
 
-        mypieces=self.getpieces(board)
-        for mine in mypieces:
-            for target in self.potentialtargets(mypieces):
-                if self.canmoveto(board, mine, target):
-                    if not self.makesuscheck(mine, target, board):
+        # Checkers and pins are found once, then every move is filtered by
+        # them. Only en passant still needs the makesuscheck make/unmake.
+        kingpos = self.kingpos(board)
+        checkers = self.opponent.attackers(board, kingpos)
+        pins = self.pins(board, kingpos)
+        checkmask = None
+        if len(checkers) == 1:
+            checkmask = BETWEEN.get((kingpos, checkers[0]), frozenset()) | \
+                        {checkers[0]}
+
+        enemyattacks = board.attackcount[self.opponent.colour]
+        if moves is None:
+            moves = self.pseudomoves(board)
+        for mine, target in moves:
+            if mine == kingpos:
+                # In check, sliders see through the square the king is leaving
+                if enemyattacks[target]:
+                    continue
+                if not checkers or \
+                   not self.opponent.attacks(board, target, kingpos):
+                    yield (mine, target)
+            elif len(checkers) > 1:
+                continue
+            elif target not in board and mine[1] != target[1] and \
+                 board[mine].piecename == 'p':
+                if not self.makesuscheck(mine, target, board):
+                    yield (mine, target)
+            elif checkmask is not None and target not in checkmask:
+                continue
+            elif mine in pins and target not in pins[mine]:
+                continue
+            else:
+                yield (mine, target)
+
+    def pseudomoves(self, board, castles=None):
+        """ Moves the piece rules allow, looked up in the move tables """
+
+        # The flags are read once: while this runs lazily a deeper search
+        # ply may set them again for another position
+        if castles is None:
+            castles = (self.can_castle_short_this_turn,
+                       self.can_castle_long_this_turn)
+        for mine in self.getpieces(board):
+            yield from self.piecemoves(board, mine, castles)
+
+    def piecemoves(self, board, mine, castles=None):
+        """ The pseudomoves of the piece on mine """
+
+        COUNTERS['piecemoves'] += 1
+        if castles is None:
+            castles = (self.can_castle_short_this_turn,
+                       self.can_castle_long_this_turn)
+        colour = self.colour
+        piecename = board[mine].piecename
+        if piecename == 'p':
+            for target in PAWNPUSHES[colour][mine]:
+                if target in board:
+                    break
+                yield (mine, target)
+                if board[mine].nrofmoves != 0:
+                    break
+            for target in PAWNCAPTURES[colour][mine]:
+                if target in board:
+                    if board[target].colour != colour:
                         yield (mine, target)
+                elif self.canenpassant(board, mine, target):
+                    yield (mine, target)
+
+        elif piecename == 'kn':
+            for target in KNIGHTJUMPS[mine]:
+                if target not in board or board[target].colour != colour:
+                    yield (mine, target)
+
+        elif piecename == 'k':
+            for target in KINGSTEPS[mine]:
+                if target not in board or board[target].colour != colour:
+                    yield (mine, target)
+            # Castling flags are only set with a clear path to the rook
+            if castles[0]:
+                yield (mine, (mine[0], mine[1]+2))
+            if castles[1]:
+                yield (mine, (mine[0], mine[1]-2))
+
+        else:
+            for squares in SLIDERRAYS[piecename][mine]:
+                for target in squares:
+                    if target in board:
+                        if board[target].colour != colour:
+                            yield (mine, target)
+                        break
+                    yield (mine, target)
+
+    def pseudocaptures(self, board, losing=None):
+        """
+        Pseudomoves taking a piece, most valuable victim first and among
+        equal victims the least valuable attacker first, en passant last.
+        Given a list, captures that lose material by see go into it instead.
+        """
+
+        colour, attacked = self.colour, board.attackcount[self.colour]
+        captures = []
+        for victim in self.opponent.getpieces(board):
+            if attacked[victim] and board[victim].piecename != 'k':
+                value = PIECEVALUES[board[victim].piecename]
+                for mine in self.attackers(board, victim):
+                    # The king, worth nothing here, takes last
+                    cost = PIECEVALUES[board[mine].piecename] or MATE
+                    # Taking with a cheaper piece never loses
+                    if losing is not None and cost > value and \
+                       self.see(board, mine, victim) < 0:
+                        losing.append((mine, victim))
+                        continue
+                    captures.append((-value, cost, mine, victim))
+        captures.sort(key=lambda capture: capture[:2])
+        for _, _, mine, victim in captures:
+            yield (mine, victim)
+
+        # A pawn that just moved two squares stands beside ours on the
+        # en passant row, we take it on the square it passed
+        row = self.enpassantrow
+        for col in range(8):
+            victim = (row, col)
+            if victim in board and board[victim].colour != colour and \
+               board[victim].piecename == 'p':
+                target = PAWNPUSHES[colour][victim][0]
+                for mine in PAWNCAPTURES[self.opponent.colour][target]:
+                    if mine[0] == row and mine in board and \
+                       board[mine].colour == colour and \
+                       board[mine].piecename == 'p' and \
+                       target not in board and \
+                       self.canenpassant(board, mine, target):
+                        yield (mine, target)
+
+    def pseudopromotions(self, board):
+        """ Pawn pushes onto the last row """
+
+        colour = self.colour
+        row = 6 if colour == 'white' else 1
+        for col in range(8):
+            mine = (row, col)
+            if mine in board and board[mine].colour == colour and \
+               board[mine].piecename == 'p':
+                target = PAWNPUSHES[colour][mine][0]
+                if target not in board:
+                    yield (mine, target)
+
+    def pseudoquiets(self, board, castles):
+        """ Pseudomoves neither capturing nor promoting """
+
+        for mine, target in self.pseudomoves(board, castles):
+            if target in board:
+                continue
+            if board[mine].piecename == 'p' and \
+               (mine[1] != target[1] or target[0] in (0, 7)):
+                continue
+            yield (mine, target)
+
+    def stagedmoves(self, board, quiets=True):
+        """
+        Legal moves generated in stages, captures then promotions then the
+        quiet moves, so a search cutting off early never builds the rest.
+        Captures losing material come after the quiet moves, and without
+        quiet moves they are left out.
+        """
+
+        # Checks and pins are found once for all stages, the castling
+        # flags now, before a deeper ply sets them for its own position
+        self.set_castling_flags(board)
+        castles = (self.can_castle_short_this_turn,
+                   self.can_castle_long_this_turn)
+        # Filled by the capture stage before the chain gets to it
+        losing = []
+        stages = [self.pseudocaptures(board, losing), self.pseudopromotions(board)]
+        if quiets:
+            stages += [self.pseudoquiets(board, castles), iter(losing)]
+        return self.get_validmoves(board, itertools.chain(*stages))
+
+    def pins(self, board, kingpos):
+        """
+        Our pieces standing between our king and an enemy slider, as
+        {square: squares of the line it may still move along}
+        """
+
+        pins = {}
+        for rays, sliders in ((ROOKRAYS, ('r', 'q')), (BISHOPRAYS, ('b', 'q'))):
+            for squares in rays[kingpos]:
+                shield = None
+                for index, square in enumerate(squares):
+                    if square in board:
+                        if board[square].colour == self.colour:
+                            if shield:
+                                break
+                            shield = square
+                        else:
+                            if shield and board[square].piecename in sliders:
+                                pins[shield] = frozenset(squares[:index+1])
+                            break
+        return pins
+
+    def canenpassant(self, board, start, target):
+        # The victim must have made its two square move in the opponent's
+        # last turn
+        if start[0] != self.enpassantrow:
+            return False
+        passant_victim = (start[0], target[1])
+        if passant_victim not in board:
+            return False
+        victim = board[passant_victim]
+        return victim.colour != self.colour and victim.piecename == 'p' and \
+               victim.nrofmoves == 1 and \
+               getattr(victim, 'turn_moved_twosquares', None) == \
+               self.opponent.playedturns-1
 
     def set_castling_flags(self, board):
         kingpos = self.kingpos(board)
@@ -95,16 +378,16 @@ class Player():
 
     def rook_can_castle_long(self, board, kingpos):
         if self.longrook in board and board[self.longrook].nrofmoves is 0:
-            if self.hasclearpath(self.longrook, kingpos, board):
+            if not any(sq in board for sq in BETWEEN[(self.longrook, kingpos)]):
                 tmptarget = (kingpos[0],kingpos[1]-1)
-                if not self.makesuscheck(kingpos, tmptarget, board):
+                if not self.opponent.attacks(board, tmptarget):
                     return True
 
     def rook_can_castle_short(self, board, kingpos):
         if self.shortrook in board and board[self.shortrook].nrofmoves is 0:
-            if self.hasclearpath(self.shortrook, kingpos, board):
+            if not any(sq in board for sq in BETWEEN[(self.shortrook, kingpos)]):
                 tmptarget = (kingpos[0],kingpos[1]+1)
-                if not self.makesuscheck(kingpos, tmptarget, board):
+                if not self.opponent.attacks(board, tmptarget):
                     return True
 
     def getposition(self, move):
@@ -118,22 +401,34 @@ class Player():
 
         return start, target
 
-    def reacheddraw(self, board):
+    def reacheddraw(self, board, dullmoves=0):
 
         if not self.validmoves and not self.isincheck(board):#now redundant as validmoves are precalculated
             return True
 
-        if len(list(self.getpieces(board))) == \
-           len(list(self.opponent.getpieces(board))) == 1:
+        if board.insufficient():
             return True
 
-        if Player.dullmoves/2 == 50:
+        if len(board) <= TBMEN:
+            value = probetablebase(board, self)
+            if value and value[0] == TBDRAW:
+                return True
+
+        if dullmoves/2 == 50:
             if self.nature is 'AI':
                 return True
             else:
                 if input("Call a draw? (yes/no) : ").lower() in ['yes','y']:
                     return True
 
+        if board.repetitions() >= 3:
+            if self.nature is 'AI':
+                return True
+            else:
+                if input("Position repeated three times, call a draw? "
+                         "(yes/no) : ").lower() in ['yes','y']:
+                    return True
+
     def ischeckmate(self, board):
 
         if not self.validmoves and self.isincheck(board):
@@ -150,35 +445,37 @@ class Player():
         return turnstring
 
     def getRandomMove(self, board):
-        return random.choice(self.validmoves)
+        return self.random.choice(self.validmoves)
     
     def getRandomCapture(self, board):
-        """ Of possible captures, return a random one """
+        """ Of possible captures not losing material, return a random one """
 
-        # Get list of computer's enemies
-        enemylist = self.opponent.getpieces(board)
+        # Only the capture stage of the move generator is needed here, the
+        # captures see finds losing are set aside
+        captures = self.pseudocaptures(board, [])
+        potentialCaptures = list(self.get_validmoves(board, captures))
 
-        # Find all possible captures
-        potentialCaptures = []
-        for enemy in enemylist:
-            for move in self.validmoves:
-                if enemy in move:
-                    potentialCaptures.append([move[0],enemy])
-
-        # If no possible captures, pick a random (non-capturing) move
+        # If no good captures, pick a random move
         if not potentialCaptures:
             return self.getRandomMove(board)
 
         else:
-            # From pieces that can capture enemy, pick a random piece
-            randompiece = random.choice(potentialCaptures)
-            start = randompiece[0]
+            return self.random.choice(potentialCaptures)
+
+    def searchmove(self, board):
+        """ Best move found by an alpha-beta search within our budget """
 
-            # Find target
-            # Using the chosen piece, pick a random capture
-            target = random.choice(randompiece[1:])
+        if self.threads > 1:
+            if self.parallel is None:
+                self.parallel = ParallelSearch(self.threads, self.hashmb or 16)
+            return self.parallel.run(board, self, self.movetime, self.maxnodes,
+                                     self.maxdepth)[:2]
 
-            return start, target
+        if self.table is None and self.hashmb:
+            self.table = TranspositionTable(self.hashmb)
+        search = Search(board, self, self.movetime, self.maxnodes, self.maxdepth,
+                        self.table)
+        return search.run()
 
     def getmove(self, board):
 
@@ -186,6 +483,16 @@ class Player():
 
             # If player is computer, get a move from computer
             if self.nature is 'AI':
+                if self.book:
+                    move = self.book.choose(board, self)
+                    if move:
+                        return move[:2]
+                if len(board) <= TBMEN:
+                    move = self.tablebasemove(board)
+                    if move:
+                        return move
+                if self.movetime or self.maxnodes or self.maxdepth:
+                    return self.searchmove(board)
                 return self.getRandomCapture(board)
 
             else:
@@ -201,11 +508,50 @@ class Player():
                     else:
                         raise IndexError
 
+    def tablebasemove(self, board):
+        """ The move with the best tablebase value, None if one is missing """
+
+        best = None
+        for start, target in self.validmoves:
+            promoteto = 'q' if self.ispromotion(board, start, target) else None
+            self.playmove(board, start, target, promoteto)
+            value = probetablebase(board, self.opponent)
+            self.takeback(board, start, target, promoteto)
+            if value is None:
+                return None
+            # The opponent's loss is our win: mate fast, lose slowly
+            result, plies = value
+            rank = {TBLOSS: (2, -plies), TBDRAW: (1, 0), TBWIN: (0, plies)}[result]
+            if best is None or rank > best[0]:
+                best = (rank, start, target)
+        return best and best[1:]
+
+    def playmove(self, board, start, target, promoteto=None):
+        """ domove plus the bookkeeping of a played turn, undone by takeback """
+
+        self.domove(board, start, target)
+        self.playedturns += 1
+        if promoteto:
+            self.promote(board, target, promoteto)
+
+    def takeback(self, board, start, target, promoteto=None):
+        if promoteto:
+            self.promote(board, target, 'p')
+        self.playedturns -= 1
+        self.unmove(board, start, target)
+
+    def ispromotion(self, board, start, target):
+        return board[start].piecename == 'p' and target[0] in (0, 7)
+
     def makesuscheck(self, start, target, board):
+        COUNTERS['makesuscheck'] += 1
         # Make temporary move to test for check
         self.domove(board, start, target)
 
-        retval = self.isincheck(board)
+        if board[target].piecename == 'k':
+            retval = self.opponent.attacks(board, target)
+        else:
+            retval = self.isincheck(board)
         
         # Undo temporary move
         self.unmove(board, start, target)
@@ -213,81 +559,281 @@ class Player():
         return retval
 
     def isincheck(self, board):
-        kingpos = self.kingpos(board)
-        for enemy in self.opponent.getpieces(board):
-            if self.opponent.canmoveto(board, enemy, kingpos):
+        COUNTERS['isincheck'] += 1
+        return board.attackcount[self.opponent.colour][board.kings[self.colour]] > 0
+
+    def defenders(self, board, square):
+        """ Number of our pieces attacking or defending square """
+
+        return board.attackcount[self.colour][square]
+
+    def attacks(self, board, square, through=None):
+        """
+        True if one of our pieces could capture on square. Sliders look
+        through the square through, as if it was empty.
+        """
+
+        COUNTERS['attacks'] += 1
+        if through is None:
+            return board.attackcount[self.colour][square] > 0
+
+        if isinstance(board, BitBoard):
+            return board.attacked(square, self.colour, through)
+
+        colour = self.colour
+        for source in PAWNCAPTURES[self.opponent.colour][square]:
+            if source in board and board[source].colour == colour and \
+               board[source].piecename == 'p':
                 return True
 
-    def domove(self, board, start, target):
+        for source in KNIGHTJUMPS[square]:
+            if source in board and board[source].colour == colour and \
+               board[source].piecename == 'kn':
+                return True
 
-        self.savedtargetpiece = None
-        if target in board:
-            self.savedtargetpiece = board[target]
+        for source in KINGSTEPS[square]:
+            if source in board and board[source].colour == colour and \
+               board[source].piecename == 'k':
+                return True
 
-        board[target] = board[start]
-        board[target].position = target
+        for rays, sliders in ((ROOKRAYS, ('r', 'q')), (BISHOPRAYS, ('b', 'q'))):
+            for squares in rays[square]:
+                for source in squares:
+                    if source in board and source != through:
+                        if board[source].colour == colour and \
+                           board[source].piecename in sliders:
+                            return True
+                        break
+
+        return False
+
+    def attackers(self, board, square):
+        """ Squares of our pieces that could capture on square """
+
+        COUNTERS['attackers'] += 1
+        if not self.attacks(board, square):
+            return []
+
+        colour = self.colour
+        found = []
+        for sources, names in ((PAWNCAPTURES[self.opponent.colour][square], ('p',)),
+                               (KNIGHTJUMPS[square], ('kn',)),
+                               (KINGSTEPS[square], ('k',))):
+            found += [source for source in sources if source in board and
+                      board[source].colour == colour and
+                      board[source].piecename in names]
+
+        for rays, sliders in ((ROOKRAYS, ('r', 'q')), (BISHOPRAYS, ('b', 'q'))):
+            for squares in rays[square]:
+                for source in squares:
+                    if source in board:
+                        if board[source].colour == colour and \
+                           board[source].piecename in sliders:
+                            found.append(source)
+                        break
+
+        return found
+
+    def see(self, board, start, target):
+        """
+        Static exchange evaluation: what our capture from start to target
+        wins in the end, in centipawns, if both sides keep recapturing on
+        target with their least valuable attacker and may stop at any
+        point. Nothing is moved on the board, the pieces behind a capturer
+        on its line join in as x-rays. Pins are not looked at.
+        """
+
+        # Attackers of both colours on target: knights, and every line to it
+        # as the queue of pieces that capture along it one after another
+        knights = [source for source in KNIGHTJUMPS[target]
+                   if source in board and board[source].piecename == 'kn']
+        lines = []
+        for rays, sliders in ((ROOKRAYS, ('r', 'q')), (BISHOPRAYS, ('b', 'q'))):
+            for squares in rays[target]:
+                queue = []
+                for source in squares:
+                    if source not in board:
+                        continue
+                    piece = board[source]
+                    if piece.piecename in sliders or not queue and \
+                       (piece.piecename == 'k' and source in KINGSTEPS[target] or
+                        piece.piecename == 'p' and sliders[0] == 'b' and
+                        target in PAWNCAPTURES[piece.colour][source]):
+                        queue.append(source)
+                    else:
+                        break
+                if queue:
+                    lines.append(queue)
+
+        def takeaway(source):
+            if source in knights:
+                knights.remove(source)
+            else:
+                for queue in lines:
+                    if queue and queue[0] == source:
+                        queue.pop(0)
+
+        def cheapest(colour):
+            sources = [source for source in knights
+                       if board[source].colour == colour]
+            sources += [queue[0] for queue in lines
+                        if queue and board[queue[0]].colour == colour]
+            return min(sources, default=None,
+                       key=lambda source: SEEVALUES[board[source].piecename])
+
+        # En passant takes a pawn that is not on target
+        victim = board[target].piecename if target in board else 'p'
+        gains = [PIECEVALUES[victim]]
+        onsquare = SEEVALUES[board[start].piecename]
+        takeaway(start)
+        colour, other = self.opponent.colour, self.colour
+        while True:
+            source = cheapest(colour)
+            if source is None:
+                break
+            takeaway(source)
+            # A king only takes when nothing can take it back
+            if board[source].piecename == 'k' and cheapest(other) is not None:
+                break
+            gains.append(onsquare - gains[-1])
+            onsquare = SEEVALUES[board[source].piecename]
+            colour, other = other, colour
+
+        # Each side stops taking once it would lose by going on
+        while len(gains) > 1:
+            last = gains.pop()
+            gains[-1] = -max(-gains[-1], last)
+        return gains[0]
+
+    def domove(self, board, start, target):
+
+        mover = board[start]
+        captured, capturedpos = board.get(target), target
+        twosquares = getattr(mover, 'turn_moved_twosquares', None)
+
+        # Zobrist key and evaluation terms of the new position
+        key = board.zobrist ^ SIDEKEY ^ board.epkey ^ \
+              PIECEKEYS[(mover.colour, mover.piecename, start)] ^ \
+              PIECEKEYS[(mover.colour, mover.piecename, target)]
+        before = PIECESQUARE[(mover.colour, mover.piecename, start)]
+        after  = PIECESQUARE[(mover.colour, mover.piecename, target)]
+        mgscore = board.mgscore + after[0] - before[0]
+        egscore = board.egscore + after[1] - before[1]
+        phase = board.phase
+
+        board[target] = mover
+        mover.position = target
         del board[start]
 
-        board[target].nrofmoves += 1
+        mover.nrofmoves += 1
+        epkey = 0
+        changed = [start, target]
 
-        if board[target].piecename is 'p' and not self.savedtargetpiece:
+        if mover.piecename is 'p' and not captured:
 
             if abs(target[0]-start[0]) == 2:
-                board[target].turn_moved_twosquares = self.playedturns
+                mover.turn_moved_twosquares = self.playedturns
+                epkey = EPKEYS[target[1]]
 
             elif abs(target[1]-start[1]) == abs(target[0]-start[0]) == 1:
                 # Pawn has done en passant, remove the victim
                 if self.colour is 'white':
-                    passant_victim = (target[0]-1, target[1])
+                    capturedpos = (target[0]-1, target[1])
                 else:
-                    passant_victim = (target[0]+1, target[1])
-                self.savedpawn = board[passant_victim]
-                del board[passant_victim]
-
-        if board[target].piecename is 'k':
+                    capturedpos = (target[0]+1, target[1])
+                captured = board[capturedpos]
+                del board[capturedpos]
+                changed.append(capturedpos)
+
+        if captured:
+            key ^= piecekey(captured, capturedpos)
+            board.material[(captured.colour, captured.piecename)] -= 1
+            lost = PIECESQUARE[(captured.colour, captured.piecename, capturedpos)]
+            mgscore -= lost[0]
+            egscore -= lost[1]
+            phase -= PHASEWEIGHTS[captured.piecename]
+
+        if mover.piecename is 'k':
+            rook = None
             if target[1]-start[1] == -2:
                 # King is castling long, move longrook
-                self.domove(board, self.longrook, self.longrook_target)
+                rook = (self.longrook, self.longrook_target)
             elif target[1]-start[1] == 2:
                 # King is castling short, move shortrook
-                self.domove(board, self.shortrook, self.shortrook_target)
+                rook = (self.shortrook, self.shortrook_target)
+            if rook:
+                key ^= self.moverook(board, rook[0], rook[1], 1)
+                changed += rook
+                before = PIECESQUARE[(self.colour, 'r', rook[0])]
+                after  = PIECESQUARE[(self.colour, 'r', rook[1])]
+                mgscore += after[0] - before[0]
+                egscore += after[1] - before[1]
+
+        # Everything unmove needs, so moves can be stacked to any depth
+        board.undostack.append((captured, capturedpos, twosquares,
+                                board.zobrist, board.epkey, board.castling,
+                                board.mgscore, board.egscore, board.phase,
+                                board.updateattacks(changed)))
+        board.mgscore, board.egscore, board.phase = mgscore, egscore, phase
+
+        if start in CASTLINGSQUARES or target in CASTLINGSQUARES:
+            castling = castlingrights(board)
+            key ^= CASTLINGKEYS[board.castling] ^ CASTLINGKEYS[castling]
+            board.castling = castling
+
+        board.epkey = epkey
+        board.zobrist = key ^ epkey
+        board.history[board.zobrist] += 1
+
+    def moverook(self, board, start, target, step):
+        # The rook's half of castling, step is 1 to move and -1 to move back.
+        # Returns the change of the Zobrist key.
+        board[target] = board[start]
+        board[target].position = target
+        del board[start]
+        board[target].nrofmoves += step
+        return piecekey(board[target], start) ^ piecekey(board[target], target)
 
     def unmove(self, board, start, target):
 
-        board[start] = board[target]
-        board[start].position = start
-        if self.savedtargetpiece:
-            board[target] = self.savedtargetpiece
-        else:
-            del board[target]
-
-        board[start].nrofmoves -= 1
-
-        if board[start].piecename is 'p' and not self.savedtargetpiece:
-
-            if abs(target[0]-start[0]) == 2:
-                del board[start].turn_moved_twosquares
-
-            elif abs(target[1]-start[1]) == abs(target[0]-start[0]) == 1:
-                # We have moved back en passant Pawn, restore captured Pawn
-                if self.colour is 'white':
-                    formerpos_passant_victim = (target[0]-1, target[1])
-                else:
-                    formerpos_passant_victim = (target[0]+1, target[1])
-                board[formerpos_passant_victim] = self.savedpawn
+        board.drophistory(board.zobrist)
+        captured, capturedpos, twosquares, board.zobrist, board.epkey, \
+            board.castling, board.mgscore, board.egscore, board.phase, \
+            replaced = board.undostack.pop()
+
+        mover = board[target]
+        board[start] = mover
+        mover.position = start
+        del board[target]
+        if captured:
+            board[capturedpos] = captured
+            board.material[(captured.colour, captured.piecename)] += 1
+
+        mover.nrofmoves -= 1
+
+        if mover.piecename is 'p' and abs(target[0]-start[0]) == 2:
+            # Restore the two square move record the pawn had before
+            if twosquares is None:
+                del mover.turn_moved_twosquares
+            else:
+                mover.turn_moved_twosquares = twosquares
 
-        if board[start].piecename is 'k':
+        if mover.piecename is 'k':
             if target[1]-start[1] == -2:
                 # King's castling long has been unmoved, move back longrook
-                self.unmove(board, self.longrook, self.longrook_target)
+                self.moverook(board, self.longrook_target, self.longrook, -1)
             elif target[1]-start[1] == 2:
                 # King's castling short has been unmoved, move back shortrook
-                self.unmove(board, self.shortrook, self.shortrook_target)
+                self.moverook(board, self.shortrook_target, self.shortrook, -1)
+
+        board.restoreattacks(replaced)
+        if mover.piecename is 'k':
+            board.kings[mover.colour] = start
 
     def pawnpromotion(self, board, target):
         if self.nature is 'AI':
             # See if Knight makes opponent checkmate
-            board[target].promote('kn')
+            self.promote(board, target, 'kn')
             if self.opponent.ischeckmate(board):
                 return
             else:
@@ -295,157 +841,25 @@ class Player():
                 
         else:
             promoteto = 'empty'
-            while promoteto.lower() not in ['kn','q']:
-                promoteto = \
-                input("You may promote your pawn:\n[Kn]ight [Q]ueen : ")
-
-        board[target].promote(promoteto)
-
-    def hasclearpath(self, start, target, board):
-
-        startcol, startrow = start[1], start[0]
-        targetcol, targetrow = target[1], target[0]
-
-        if abs(startrow - targetrow) <= 1 and abs(startcol - targetcol) <= 1:
-            # The base case
-            return True
-        else:
-            if targetrow > startrow and targetcol == startcol:
-                # Straight down
-                tmpstart = (startrow+1,startcol)
-            elif targetrow < startrow and targetcol == startcol:
-                # Straight up
-                tmpstart = (startrow-1,startcol)
-            elif targetrow == startrow and targetcol > startcol:
-                # Straight right
-                tmpstart = (startrow,startcol+1)
-            elif targetrow == startrow and targetcol < startcol:
-                # Straight left
-                tmpstart = (startrow,startcol-1)
-            elif targetrow > startrow and targetcol > startcol:
-                # Diagonal down right
-                tmpstart = (startrow+1,startcol+1)
-            elif targetrow > startrow and targetcol < startcol:
-                # Diagonal down left
-                tmpstart = (startrow+1,startcol-1)
-            elif targetrow < startrow and targetcol > startcol:
-                # Diagonal up right
-                tmpstart = (startrow-1,startcol+1)
-            elif targetrow < startrow and targetcol < startcol:
-                # Diagonal up left
-                tmpstart = (startrow-1,startcol-1)
-
-            # If no pieces in the way, test next square
-            if tmpstart in board:
-                return False
-            else:
-                return self.hasclearpath(tmpstart, target, board)
-
-    def canmoveto(self, board, start, target):
-
-        startpiece = board[start].piecename.upper()
-
-        if startpiece == 'R' and not self.check_rook(start, target):
-            return False
-        elif startpiece == 'KN' and not self.check_knight(start, target):
-            return False
-        elif startpiece == 'P' and not self.check_pawn(start, target, board):
-            return False
-        elif startpiece == 'B' and not self.check_bishop(start, target):
-            return False
-        elif startpiece == 'Q' and not self.check_queen(start, target):
-            return False
-        elif startpiece == 'K' and not self.check_king(start, target):
-            return False
-
-        # Only the 'Knight' may jump over pieces
-        if startpiece in 'RPBQK':
-            if not self.hasclearpath(start, target, board):
-                return False
-
-        return True
-
-    def check_rook(self, start, target):
-
-        # Check for straight lines of movement(start/target on same axis)
-        if start[0] == target[0] or start[1] == target[1]:
-            return True
-
-    def check_knight(self, start, target):
-
-        # 'Knight' may move 2+1 in any direction and jump over pieces
-        if abs(target[0]-start[0]) == 2 and abs(target[1]-start[1]) == 1:
-            return True
-        elif abs(target[0]-start[0]) == 1 and abs(target[1]-start[1]) == 2:
-            return True
-
-    def check_pawn(self, start, target, board):
-
-        # Disable backwards and sideways movement
-        if 'white' in self.colour and target[0] < start[0]:
-            return False
-        elif 'black' in self.colour and target[0] > start[0]:
-            return False
-        if start[0] == target[0]:
-            return False
-
-        if target in board:
-            # Only attack if one square diagonaly away
-            if abs(target[1]-start[1]) == abs(target[0]-start[0]) == 1:
-                return True
-        else:
-            # Make peasants move only one forward (except first move)
-            if start[1] == target[1]:
-                # Normal one square move
-                if abs(target[0]-start[0]) == 1:
-                    return True
-                # 1st exception to the rule, 2 square move first time
-                if board[start].nrofmoves is 0:
-                    if abs(target[0]-start[0]) == 2:
-                        return True
-
-            # 2nd exception to the rule, en passant
-            if start[0] == self.enpassantrow:
-                if abs(target[0]-start[0]) == 1:
-                    if abs(target[1]-start[1]) == 1:
-                        if target[1]-start[1] == -1:
-                            passant_victim = (start[0], start[1]-1)
-                        elif target[1]-start[1] == 1:
-                            passant_victim = (start[0], start[1]+1)
-                        if passant_victim in board and \
-                        board[passant_victim].colour is not self.colour and \
-                        board[passant_victim].piecename is 'p'and \
-                        board[passant_victim].nrofmoves == 1 and \
-                        board[passant_victim].turn_moved_twosquares == \
-                        self.playedturns-1:
-                            return True
-
-    def check_bishop(self, start, target):
-
-        # Check for non-horizontal/vertical and linear movement
-        if abs(target[1]-start[1]) == abs(target[0]-start[0]):
-            return True
-
-    def check_queen(self, start, target):
-
-        # Will be true if move can be done as Rook or Bishop
-        if self.check_rook(start, target) or self.check_bishop(start, target):
-            return True
-
-    def check_king(self, start, target):
-
-        # King can move one square in any direction
-        if abs(target[0]-start[0]) <= 1 and abs(target[1]-start[1]) <= 1:
-            return True
-
-        # ..except when castling
-        if self.can_castle_short_this_turn:
-            if target[1]-start[1] == 2 and start[0] == target[0]:
-                return True
-
-        if self.can_castle_long_this_turn:
-            if target[1]-start[1] == -2 and start[0] == target[0]:
-                return True
+            while promoteto.lower() not in PROMOTIONS:
+                promoteto = input("You may promote your pawn:\n"
+                                  "[Kn]ight [Q]ueen [R]ook [B]ishop : ")
+
+        self.promote(board, target, promoteto)
+
+    def promote(self, board, target, to):
+        board.drophistory(board.zobrist)
+        board.material[(self.colour, board[target].piecename)] -= 1
+        board.zobrist ^= piecekey(board[target], target)
+        board.addscores(board[target], target, -1)
+        board[target].promote(to)
+        board.zobrist ^= piecekey(board[target], target)
+        board.addscores(board[target], target, 1)
+        board.material[(self.colour, board[target].piecename)] += 1
+        board.history[board.zobrist] += 1
+        # Storing the piece again lets a BitBoard move it to its new bitboard
+        board[target] = board[target]
+        board.updateattacks([target])
 
 class Piece():
     def __init__(self, piecename, position, player):
@@ -478,14 +892,509 @@ class Piece():
             return True
 
     def promote(self, to):
-        self.piecename = to.lower()
+        # Interned, as piece names are compared with 'is'
+        self.piecename = sys.intern(to.lower())
+
+    def __setstate__(self, state):
+        # A board sent to another process must keep the names interned too
+        for name in ('colour', 'nature', 'piecename'):
+            state[name] = sys.intern(state[name])
+        self.__dict__.update(state)
+
+
+# Zobrist keys, seeded so every process hashes a position the same way
+_zobristrandom = random.Random(20120101)
+PIECEKEYS = {(colour, name, sq): _zobristrandom.getrandbits(64)
+             for colour in PAWNDIRS for name in ('p', 'r', 'kn', 'b', 'q', 'k')
+             for sq in ALLSQUARES}
+SIDEKEY = _zobristrandom.getrandbits(64)
+EPKEYS = [_zobristrandom.getrandbits(64) for col in range(8)]
+CASTLINGKEYS = [0] + [_zobristrandom.getrandbits(64) for rights in range(15)]
+
+# Castling right bits as (colour, king square, rook square), in FEN order KQkq
+CASTLING = [('white', (0, 4), (0, 7)), ('white', (0, 4), (0, 0)),
+            ('black', (7, 4), (7, 7)), ('black', (7, 4), (7, 0))]
+CASTLINGSQUARES = {sq for right in CASTLING for sq in right[1:]}
+
+def piecekey(piece, square):
+    return PIECEKEYS[(piece.colour, piece.piecename, square)]
+
+def castlingrights(board):
+    """ Castling rights as bits of CASTLING, from the unmoved kings and rooks """
+
+    rights = 0
+    for bit, (colour, king, rook) in enumerate(CASTLING):
+        if all(pos in board and board[pos].nrofmoves == 0 and
+               board[pos].piecename == name and board[pos].colour == colour
+               for pos, name in [(rook, 'r'), (king, 'k')]):
+            rights |= 1 << bit
+    return rights
+
+
+def attackedsquares(board, piece, square):
+    """ Squares the piece on square attacks, whether empty or occupied """
+
+    name = piece.piecename
+    if name == 'p':
+        return PAWNCAPTURES[piece.colour][square]
+    elif name == 'kn':
+        return KNIGHTJUMPS[square]
+    elif name == 'k':
+        return KINGSTEPS[square]
+
+    attacked = []
+    for squares in SLIDERRAYS[name][square]:
+        for target in squares:
+            attacked.append(target)
+            if target in board:
+                break
+    return attacked
+
+
+class BoardState():
+    """ Position state that Player.domove and unmove keep up to date """
+
+    def resetstate(self):
+        self.zobrist  = 0
+        self.epkey    = 0
+        self.castling = 0
+        self.undostack = []
+        # Attack maps: how many pieces of each colour attack every square,
+        # and the squares attacked from every occupied square
+        self.attackcount = {colour: dict.fromkeys(ALLSQUARES, 0)
+                            for colour in PAWNDIRS}
+        self.attackfrom = {}
+        self.kings = {}
+        # Times each position of the game and the current search line was
+        # on the board, by Zobrist key, and pieces by (colour, piecename)
+        self.history  = collections.Counter()
+        self.material = collections.Counter()
+        # Material and piece-square sums, white's minus black's, for the
+        # middlegame and the endgame, and the phase blending the two
+        self.mgscore = 0
+        self.egscore = 0
+        self.phase   = 0
+
+    def initmaterial(self):
+        self.material = collections.Counter((self[pos].colour, self[pos].piecename)
+                                            for pos in self)
+
+    def initscores(self):
+        self.mgscore, self.egscore, self.phase = self.computescores()
+
+    def computescores(self):
+        """ The evaluation terms from scratch, as (mgscore, egscore, phase) """
+
+        mgscore = egscore = phase = 0
+        for pos in self:
+            piece = self[pos]
+            mg, eg = PIECESQUARE[(piece.colour, piece.piecename, pos)]
+            mgscore += mg
+            egscore += eg
+            phase += PHASEWEIGHTS[piece.piecename]
+        return mgscore, egscore, phase
+
+    def verifyscores(self):
+        """ Raise AssertionError if the evaluation terms differ from a recount """
+
+        assert (self.mgscore, self.egscore, self.phase) == self.computescores()
+
+    def addscores(self, piece, square, sign):
+        """ Add (sign 1) or take away (sign -1) the terms of piece on square """
+
+        mg, eg = PIECESQUARE[(piece.colour, piece.piecename, square)]
+        self.mgscore += sign * mg
+        self.egscore += sign * eg
+        self.phase   += sign * PHASEWEIGHTS[piece.piecename]
+
+    def drophistory(self, key):
+        """ Count one visit of key less, keeping no zero counts """
+
+        if self.history[key] == 1:
+            del self.history[key]
+        else:
+            self.history[key] -= 1
 
+    def repetitions(self):
+        """ Times the current position has been on the board """
+        return self.history[self.zobrist]
 
-class Game():
+    def insufficient(self):
+        """ True if no side can mate: no pawns, rooks or queens and at most
+            one knight or bishop left """
+
+        material = self.material
+        if any(material[(colour, name)] for colour in PAWNDIRS
+               for name in ('p', 'r', 'q')):
+            return False
+        return sum(material[(colour, name)] for colour in PAWNDIRS
+                   for name in ('kn', 'b')) <= 1
+
+    def updateattacks(self, changed):
+        """
+        Bring the attack maps up to date after the squares in changed got
+        a new occupant or were emptied. The pieces affected are the ones on
+        those squares and the sliders whose lines reach them. Returns their
+        old entries for restoreattacks.
+        """
+
+        COUNTERS['updateattacks'] += 1
+        affected = set(changed)
+        for square in changed:
+            for squares, sliders in SLIDERLINES[square]:
+                for source in squares:
+                    if source in self:
+                        if self[source].piecename in sliders:
+                            affected.add(source)
+                        break
+
+        attackfrom, attackcount = self.attackfrom, self.attackcount
+        replaced = []
+        for square in affected:
+            old = attackfrom.pop(square, None)
+            replaced.append((square, old))
+            if old:
+                counts = attackcount[old[0]]
+                for target in old[1]:
+                    counts[target] -= 1
+            piece = self.get(square)
+            if piece:
+                attacked = attackedsquares(self, piece, square)
+                attackfrom[square] = (piece.colour, attacked)
+                counts = attackcount[piece.colour]
+                for target in attacked:
+                    counts[target] += 1
+                if piece.piecename == 'k':
+                    self.kings[piece.colour] = square
+        return replaced
+
+    def restoreattacks(self, replaced):
+        """ Put back the entries updateattacks replaced, for unmove """
+
+        attackfrom, attackcount = self.attackfrom, self.attackcount
+        for square, old in replaced:
+            new = attackfrom.pop(square, None)
+            if new:
+                counts = attackcount[new[0]]
+                for target in new[1]:
+                    counts[target] -= 1
+            if old:
+                attackfrom[square] = old
+                counts = attackcount[old[0]]
+                for target in old[1]:
+                    counts[target] += 1
+
+    def initattacks(self):
+        self.attackcount = {colour: dict.fromkeys(ALLSQUARES, 0)
+                            for colour in PAWNDIRS}
+        self.attackfrom = {}
+        self.kings = {}
+        # Every piece is affected, so updateattacks' search for the sliders
+        # reaching a square is not needed
+        for square, piece in self.items():
+            attacked = attackedsquares(self, piece, square)
+            self.attackfrom[square] = (piece.colour, attacked)
+            counts = self.attackcount[piece.colour]
+            for target in attacked:
+                counts[target] += 1
+            if piece.piecename == 'k':
+                self.kings[piece.colour] = square
+
+    def verifyattacks(self):
+        """ Raise AssertionError if the attack maps differ from a recount """
+
+        counts = {colour: dict.fromkeys(ALLSQUARES, 0) for colour in PAWNDIRS}
+        for square in self:
+            for target in attackedsquares(self, self[square], square):
+                counts[self[square].colour][target] += 1
+        assert counts == self.attackcount
+        assert set(self.attackfrom) == set(self)
+
+    def computekey(self, colour):
+        """ Zobrist key from scratch, with colour to move """
+
+        key = SIDEKEY if colour == 'black' else 0
+        for pos in self:
+            key ^= piecekey(self[pos], pos)
+        return key ^ self.epkey ^ CASTLINGKEYS[self.castling]
+
+
+class Board(BoardState, dict):
+    """ The dict board, keyed by (row, col) with Piece values """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.resetstate()
+
+
+# Bit number of each square on a BitBoard, and the masks of the move tables
+SQUAREBITS   = {sq: 1 << (sq[0]*8 + sq[1]) for sq in ALLSQUARES}
+KNIGHTMASKS  = {sq: sum(SQUAREBITS[s] for s in KNIGHTJUMPS[sq])
+                for sq in ALLSQUARES}
+KINGMASKS    = {sq: sum(SQUAREBITS[s] for s in KINGSTEPS[sq])
+                for sq in ALLSQUARES}
+PAWNMASKS    = {colour: {sq: sum(SQUAREBITS[s] for s in PAWNCAPTURES[colour][sq])
+                         for sq in ALLSQUARES}
+                for colour in PAWNDIRS}
+
+
+class BitBoard(BoardState, MutableMapping):
+    """
+    Board with one 64-bit integer per piece type and colour, plus occupancy
+    masks. Works as a drop-in for the dict board, keyed by (row, col) with
+    Piece values, so Game and Player run on it unchanged.
+    """
+
+    def __init__(self, board=()):
+        self.bitboards = {(colour, name): 0 for colour in PAWNDIRS
+                          for name in ('p', 'r', 'kn', 'b', 'q', 'k')}
+        self.occupied  = {colour: 0 for colour in PAWNDIRS}
+        self.occupancy = 0
+        self.mailbox   = [None] * 64
+        self.kinds     = [None] * 64
+        self.resetstate()
+        for pos in board:
+            self[pos] = board[pos]
+
+    def __getitem__(self, pos):
+        piece = self.mailbox[pos[0]*8 + pos[1]]
+        if piece is None:
+            raise KeyError(pos)
+        return piece
+
+    def __contains__(self, pos):
+        return self.occupancy & SQUAREBITS[pos] != 0
+
+    def __setitem__(self, pos, piece):
+        if self.mailbox[pos[0]*8 + pos[1]] is not None:
+            del self[pos]
+        bit, kind = SQUAREBITS[pos], (piece.colour, piece.piecename)
+        self.bitboards[kind] |= bit
+        self.occupied[piece.colour] |= bit
+        self.occupancy |= bit
+        self.mailbox[pos[0]*8 + pos[1]] = piece
+        # Promotion renames the Piece in place, so remember what we stored
+        self.kinds[pos[0]*8 + pos[1]] = kind
+
+    def __delitem__(self, pos):
+        index = pos[0]*8 + pos[1]
+        if self.mailbox[index] is None:
+            raise KeyError(pos)
+        bit, kind = SQUAREBITS[pos], self.kinds[index]
+        self.bitboards[kind] ^= bit
+        self.occupied[kind[0]] ^= bit
+        self.occupancy ^= bit
+        self.mailbox[index] = None
+        self.kinds[index] = None
+
+    def __iter__(self):
+        return iter(self.positions(self.occupancy))
+
+    def __len__(self):
+        return bin(self.occupancy).count('1')
+
+    @staticmethod
+    def positions(bits):
+        positions = []
+        while bits:
+            lowest = bits & -bits
+            index = lowest.bit_length() - 1
+            positions.append(ALLSQUARES[index])
+            bits ^= lowest
+        return positions
+
+    @staticmethod
+    def first(bits):
+        if bits:
+            return ALLSQUARES[(bits & -bits).bit_length() - 1]
+
+    def attacked(self, square, colour, through=None):
+        """ True if a piece of colour could capture on square """
+
+        occupancy = self.occupancy
+        if through:
+            occupancy &= ~SQUAREBITS[through]
+        other = 'black' if colour == 'white' else 'white'
+        bitboards = self.bitboards
+        if PAWNMASKS[other][square] & bitboards[(colour, 'p')] or \
+           KNIGHTMASKS[square] & bitboards[(colour, 'kn')] or \
+           KINGMASKS[square] & bitboards[(colour, 'k')]:
+            return True
+
+        queens = bitboards[(colour, 'q')]
+        for rays, sliders in ((ROOKRAYS, bitboards[(colour, 'r')] | queens),
+                              (BISHOPRAYS, bitboards[(colour, 'b')] | queens)):
+            if not sliders:
+                continue
+            for squares in rays[square]:
+                for source in squares:
+                    bit = SQUAREBITS[source]
+                    if occupancy & bit:
+                        if sliders & bit:
+                            return True
+                        break
+        return False
+
+    def verify(self):
+        """ Raise AssertionError if the bitboards disagree with the pieces """
+
+        occupancy = 0
+        for index, piece in enumerate(self.mailbox):
+            bit = 1 << index
+            for kind, bits in self.bitboards.items():
+                wanted = piece is not None and \
+                         kind == (piece.colour, piece.piecename)
+                assert bool(bits & bit) == wanted, (ALLSQUARES[index], kind)
+            if piece is not None:
+                assert self.occupied[piece.colour] & bit
+                occupancy |= bit
+        assert occupancy == self.occupancy
+        assert self.occupied['white'] | self.occupied['black'] == occupancy
+        assert not self.occupied['white'] & self.occupied['black']
+
+
+def sameboard(board, other):
+    """ Cross-check two board representations square by square """
+
+    if set(board) != set(other):
+        return False
+    return all(board[pos] is other[pos] or
+               (str(board[pos]) == str(other[pos]) and
+                board[pos].nrofmoves == other[pos].nrofmoves)
+               for pos in board)
+
+
+BOARDS = {'dict': Board, 'bitboard': BitBoard}
+FENLETTERS = {'p': 'p', 'n': 'kn', 'b': 'b', 'r': 'r', 'q': 'q', 'k': 'k'}
+
+
+# Calls to the move generation hot paths, always counted
+COUNTERS = collections.Counter()
+
+
+class TurnStats():
+    """
+    Seconds spent in each phase of a turn (getmove, domove, validmoves,
+    status) and the hot path calls made during it, for a per-game summary.
+    Phases are charged the time since the previous mark of the turn.
+    """
+
+    def __init__(self):
+        self.turns = []
+        self.current = None
+
+    def begin(self, player, ply):
+        self.current = {'ply': ply, 'colour': player.colour,
+                        'phases': collections.Counter()}
+        self.counts = COUNTERS.copy()
+        self.mark = time.perf_counter()
+
+    def phase(self, name):
+        # makemove also runs outside of timed turns, e.g. replaying a game
+        if self.current is None:
+            return
+        now = time.perf_counter()
+        self.current['phases'][name] += now - self.mark
+        self.mark = now
+
+    def end(self):
+        self.current['calls'] = dict(COUNTERS - self.counts)
+        self.current['phases'] = dict(self.current['phases'])
+        self.turns.append(self.current)
+        self.current = None
+
+    def summary(self):
+        """ Totals over the game and every turn, ready for json.dumps """
+
+        phases, calls = collections.Counter(), collections.Counter()
+        for turn in self.turns:
+            phases.update(turn['phases'])
+            calls.update(turn['calls'])
+        return {'turns': len(self.turns), 'seconds': sum(phases.values()),
+                'phases': dict(phases), 'calls': dict(calls),
+                'perturn': self.turns}
+
+
+class TerminalRenderer():
+    """
+    Draws the screen of an interactive game with one write per frame. The
+    first frame is drawn in full, later frames only rewrite the squares that
+    changed since, using ANSI cursor addressing. Only used on a terminal,
+    Game.refreshscreen prints the board as before otherwise.
+    """
+
+    # Screen lines (1-based) of the header, the first row of pieces and the
+    # line below the board, as laid out by Game.header and Game.boardlines
+    HEADERLINES = 1
+    PIECELINE = HEADERLINES + 7
+    BOTTOMLINE = HEADERLINES + 34
+    # Room below the board for the turn text, messages and the prompt
+    MARGIN = 6
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.tty = self.stream.isatty()
+        self.header = None
+        self.drawn = {}
+
+    def fits(self):
+        """ False if the terminal would scroll and break the cursor addressing """
+
+        try:
+            lines = os.get_terminal_size(self.stream.fileno()).lines
+        except OSError:
+            return False
+        return lines >= self.BOTTOMLINE + self.MARGIN
+
+    def frame(self, game, player):
+        """ The escape sequences taking the screen to the current position """
+
+        header = game.header(player)
+        squares = {square: game.cell(square) for square in ALLSQUARES}
+
+        if header != self.header or not self.drawn or not self.fits():
+            frame = '\x1b[H\x1b[2J' + header + '\n' + \
+                    '\n'.join(game.boardlines()) + '\n'
+        else:
+            parts = [f'\x1b[{self.PIECELINE+3*row};{6+5*col}H{text}'
+                     for (row, col), text in squares.items()
+                     if self.drawn[(row, col)] != text]
+            # Wipe the old turn text and prompt below the board
+            parts.append(f'\x1b[{self.BOTTOMLINE};1H\x1b[J')
+            frame = ''.join(parts)
+
+        self.header, self.drawn = header, squares
+        return frame
+
+    def draw(self, game, player):
+
+        data = self.frame(game, player).encode()
+        # Anything print() buffered must reach the screen first
+        self.stream.flush()
+        fd = self.stream.fileno()
+        while data:
+            data = data[os.write(fd, data):]
 
-    def __init__(self, playera, playerb):
+    def reset(self):
+        """ Draw the next frame in full, e.g. after other output """
+        self.drawn = {}
 
-        self.board = dict()
+
+class Game():
+
+    def __init__(self, playera, playerb, backend='dict'):
+
+        self.backend = backend
+        self.players = {playera.colour: playera, playerb.colour: playerb}
+        # Plies since the last capture or pawn move, for the fifty move rule
+        self.dullmoves = 0
+        self.moves = []
+        # Set to a TerminalRenderer for interactive games
+        self.renderer = None
+        # Set to a GameLog that has begun a game to record the moves played
+        self.log = None
+        self.stats = TurnStats()
+        self.board = BOARDS[backend]()
         for player in [playera, playerb]:
             if player.colour is 'white':
                 brow, frow = 0, 1
@@ -510,61 +1419,179 @@ class Game():
             self.board.setdefault((brow,3),  Piece('q', (brow,3), player))
             self.board.setdefault((brow,4),  Piece('k', (brow,4), player))
 
-    def printboard(self):
+        self.initstate(self.players['white'])
+
+    def initstate(self, player):
+        """ Compute the board's incrementally kept state, player to move """
+
+        enpassant = self.enpassant(player)
+        self.board.resetstate()
+        self.board.initattacks()
+        self.board.castling = castlingrights(self.board)
+        if enpassant != '-':
+            self.board.epkey = EPKEYS[ord(enpassant[0]) - 97]
+        self.board.zobrist = self.board.computekey(player.colour)
+        self.board.initmaterial()
+        self.board.initscores()
+        self.board.history[self.board.zobrist] = 1
+
+    def setfen(self, fen):
+        """ Set up the position of a FEN string, returns the player to move """
+
+        fields = fen.split()
+        placement, tomove = fields[0], fields[1]
+        if tomove not in ('w', 'b'):
+            raise ValueError(f"Bad side to move {tomove}")
+        castling  = fields[2] if len(fields) > 2 else '-'
+        enpassant = fields[3] if len(fields) > 3 else '-'
+        halfmoves = int(fields[4]) if len(fields) > 4 else 0
+        fullmoves = int(fields[5]) if len(fields) > 5 else 1
+
+        white, black = self.players['white'], self.players['black']
+        white.playedturns = fullmoves - 1 + (tomove == 'b')
+        black.playedturns = fullmoves - 1
+        self.dullmoves = halfmoves
+
+        self.board = BOARDS[self.backend]()
+        for rank, rankstring in enumerate(placement.split('/')):
+            col = 0
+            for letter in rankstring:
+                if letter.isdigit():
+                    col += int(letter)
+                    continue
+                player = white if letter.isupper() else black
+                pos = (7-rank, col)
+                piece = Piece(FENLETTERS[letter.lower()], pos, player)
+                # Only unmoved pieces may castle or make a two square move
+                if piece.piecename != 'p' or pos[0] != (1 if player is white else 6):
+                    piece.nrofmoves = 1
+                self.board[pos] = piece
+                col += 1
+
+        for letter, player in zip('KQkq', [white, white, black, black]):
+            if letter not in castling:
+                continue
+            rook = player.shortrook if letter in 'Kk' else player.longrook
+            king = (rook[0], 4)
+            for pos, name in [(rook, 'r'), (king, 'k')]:
+                if pos in self.board and self.board[pos].piecename == name:
+                    self.board[pos].nrofmoves = 0
+
+        if enpassant != '-':
+            col, row = ord(enpassant[0]) - 97, int(enpassant[1]) - 1
+            victim = self.board[(4 if row == 5 else 3, col)]
+            owner = self.players[victim.colour]
+            victim.turn_moved_twosquares = owner.playedturns - 1
+
+        for player in [white, black]:
+            player.validmoves = []
+            player.can_castle_long_this_turn  = False
+            player.can_castle_short_this_turn = False
+
+        player = white if tomove == 'w' else black
+        self.initstate(player)
+        return player
+
+    def getfen(self, player):
+        """ FEN string of the position with player to move """
+
+        letters = {name: letter for letter, name in FENLETTERS.items()}
+        ranks = []
+        for row in range(7, -1, -1):
+            rankstring, empty = '', 0
+            for col in range(8):
+                if (row, col) not in self.board:
+                    empty += 1
+                    continue
+                piece = self.board[(row, col)]
+                letter = letters[piece.piecename]
+                rankstring += str(empty or '') + \
+                    (letter.upper() if piece.colour == 'white' else letter)
+                empty = 0
+            ranks.append(rankstring + str(empty or ''))
+
+        rights = castlingrights(self.board)
+        castling = ''.join(letter for bit, letter in enumerate('KQkq')
+                           if rights & 1 << bit)
+
+        fullmoves = self.players['black'].playedturns + 1
+        return f"{'/'.join(ranks)} {player.colour[0]} {castling or '-'} " \
+               f"{self.enpassant(player)} {self.dullmoves} {fullmoves}"
+
+    def enpassant(self, player):
+        """ The en passant square of the FEN with player to move, or '-' """
+
+        enpassant = '-'
+        opponent = player.opponent
+        for pos in opponent.getpieces(self.board):
+            piece = self.board[pos]
+            if piece.piecename == 'p' and piece.nrofmoves == 1 and \
+               getattr(piece, 'turn_moved_twosquares', None) == \
+               opponent.playedturns - 1:
+                behind = pos[0] - PAWNDIRS[piece.colour]
+                enpassant = f"{chr(pos[1]+97)}{behind+1}"
+        return enpassant
+
+    def boardlines(self):
+        """ The lines of the board as printboard prints them """
 
         topbottom=['*','a','b','c','d','e','f','g','h','*']
         sides=['1','2','3','4','5','6','7','8']
         tbspacer=' '*3
         rowspacer=' '*3
         cellspacer=' '*4
-        empty=' '*3
-        
-        print("\n")
-        for field in topbottom:
-            print(f"{field:4s}", end=" ")
-        print("\n")
 
-        print(f"{tbspacer} {('_'*4+' ')*8}")
+        edge = ''.join(f"{field:4s} " for field in topbottom)
+        lines = ['', '', edge, '', f"{tbspacer} {('_'*4+' ')*8}"]
 
         for row in range(8):
-            print(f"{rowspacer}{('|'+cellspacer)*9}")
-            print(f"{sides[row]:3s}|", end=" ")
-            for col in range(8):
-                if (row, col) not in self.board:
-                    print(f"{empty}|", end=" ")
-                else:
-                    piece = self.board[(row, col)].__str__()
-                    print(f"{piece:2s} |", end=" ")
-            print(f"{sides[row]:2s}", end=" ")
-            print("")
-            print(f"{rowspacer}|{('_'*4+'|')*8}")
-        print("\n")
+            lines.append(f"{rowspacer}{('|'+cellspacer)*9}")
+            cells = ''.join(f"{self.cell((row, col))}| " for col in range(8))
+            lines.append(f"{sides[row]:3s}| {cells}{sides[row]:2s} ")
+            lines.append(f"{rowspacer}|{('_'*4+'|')*8}")
 
-        for field in topbottom:
-            print(f"{field:4s}", end=" ")
-        print("\n")
+        lines += ['', '', edge, '']
+        return lines
 
-    def refreshscreen(self, player):
+    def cell(self, square):
+        """ Three characters showing the square's piece, if any """
+
+        if square not in self.board:
+            return ' '*3
+        return f"{self.board[square].__str__():2s} "
+
+    def printboard(self):
+        print('\n'.join(self.boardlines()))
+
+    def header(self, player):
         if player.colour is 'white':
             playera, playerb = player, player.opponent
         else:
             playera, playerb = player.opponent, player
+        return f"   Now playing: {playera} vs {playerb}"
+
+    def refreshscreen(self, player):
+        if self.renderer and self.renderer.tty:
+            self.renderer.draw(self, player)
+            return
+
         clear()
 
-        print(f"   Now playing: {playera} vs {playerb}")
+        print(self.header(player))
         self.printboard()
 
     def run(self, player):
             
         self.refreshscreen(player)
 
-        while True:
+        # updating validmoves for players using current board
+        player.validmoves = list(player.get_validmoves(self.board))
 
-            # updating validmoves for players using current board
-            player.validmoves = list(player.get_validmoves(self.board))
+        while True:
 
             print(player.turn(self.board))
 
+            self.stats.begin(player, len(self.moves) + 1)
             try:
                 start, target = player.getmove(self.board)
 
@@ -577,30 +1604,74 @@ class Game():
                 break
 
             else:
-                if target in self.board or self.board[start].piecename is 'p':
-                    Player.dullmoves = 0
+                self.stats.phase('getmove')
+                player = self.makemove(player, start, target)
+
+                result = self.status(player)
+                self.stats.phase('status')
+                self.stats.end()
+                if result:
+                    return result, player
                 else:
-                    Player.dullmoves += 1
+                    self.refreshscreen(player)
 
-                player.domove(self.board, start, target)
-                player.playedturns += 1
+    def makemove(self, player, start, target, promoteto=None):
+        """ Play a move of player on the board, returns the player to move """
 
-                # Check if there is a Pawn up for promotion
-                if self.board[target].piecename is 'p':
-                    if self.board[target].canbepromoted():
-                        player.pawnpromotion(self.board, target)
+        if target in self.board or self.board[start].piecename is 'p':
+            self.dullmoves = 0
+        else:
+            self.dullmoves += 1
+
+        player.domove(self.board, start, target)
+        player.playedturns += 1
+
+        # Check if there is a Pawn up for promotion, only a promotion is
+        # recorded with a piece
+        promoted = None
+        if self.board[target].piecename is 'p':
+            if self.board[target].canbepromoted():
+                if promoteto:
+                    player.promote(self.board, target, promoteto)
+                else:
+                    player.pawnpromotion(self.board, target)
+                promoted = self.board[target].piecename
 
-                player = player.opponent
-                player.validmoves = list(player.get_validmoves(self.board))
+        self.moves.append(movestring(start, target, promoted))
+        if self.log:
+            self.log.record(start, target, promoted)
+        self.stats.phase('domove')
 
-                if player.reacheddraw(self.board):
-                    return 1, player
+        player = player.opponent
+        player.validmoves = list(player.get_validmoves(self.board))
+        self.stats.phase('validmoves')
+        return player
 
-                elif player.ischeckmate(self.board):
-                    return 2, player
+    def status(self, player):
+        """ 1 if player to move has reached a draw, 2 if checkmate, else None """
 
-                else:
-                    self.refreshscreen(player)
+        if player.reacheddraw(self.board, self.dullmoves):
+            return 1
+
+        elif player.ischeckmate(self.board):
+            return 2
+
+    def autoplay(self, player, maxplies=None):
+        """ Play AI moves without any output, returns result and player to move """
+
+        player.validmoves = list(player.get_validmoves(self.board))
+        result = self.status(player)
+        while not result:
+            if maxplies is not None and len(self.moves) >= maxplies:
+                break
+            self.stats.begin(player, len(self.moves) + 1)
+            start, target = player.getmove(self.board)
+            self.stats.phase('getmove')
+            player = self.makemove(player, start, target)
+            result = self.status(player)
+            self.stats.phase('status')
+            self.stats.end()
+        return result, player
 
     def end(self, player, result):
 
@@ -617,6 +1688,1218 @@ class Game():
 
         return endstring
     
+PIECEVALUES = {'p': 100, 'kn': 320, 'b': 330, 'r': 500, 'q': 900, 'k': 0}
+MATE = 100000
+# Exchanges end with the king, the one piece that can not be taken
+SEEVALUES = dict(PIECEVALUES, k=MATE)
+
+# Mate scores count plies from the root, the table stores them from the node
+def totable(score, ply):
+    if abs(score) < MATE - 1000:
+        return score
+    return score + ply if score > 0 else score - ply
+
+def fromtable(score, ply):
+    if abs(score) < MATE - 1000:
+        return score
+    return score - ply if score > 0 else score + ply
+
+# Piece-square tables, from white's side with the eighth row first as a
+# board is printed. Pieces other than pawns and the king use the same
+# table in the middlegame and the endgame.
+MGVALUES = dict(PIECEVALUES)
+EGVALUES = dict(PIECEVALUES)
+MGTABLES = {
+    'p':  [  0,   0,   0,   0,   0,   0,   0,   0,
+            50,  50,  50,  50,  50,  50,  50,  50,
+            10,  10,  20,  30,  30,  20,  10,  10,
+             5,   5,  10,  25,  25,  10,   5,   5,
+             0,   0,   0,  20,  20,   0,   0,   0,
+             5,  -5, -10,   0,   0, -10,  -5,   5,
+             5,  10,  10, -20, -20,  10,  10,   5,
+             0,   0,   0,   0,   0,   0,   0,   0],
+    'kn': [-50, -40, -30, -30, -30, -30, -40, -50,
+           -40, -20,   0,   0,   0,   0, -20, -40,
+           -30,   0,  10,  15,  15,  10,   0, -30,
+           -30,   5,  15,  20,  20,  15,   5, -30,
+           -30,   0,  15,  20,  20,  15,   0, -30,
+           -30,   5,  10,  15,  15,  10,   5, -30,
+           -40, -20,   0,   5,   5,   0, -20, -40,
+           -50, -40, -30, -30, -30, -30, -40, -50],
+    'b':  [-20, -10, -10, -10, -10, -10, -10, -20,
+           -10,   0,   0,   0,   0,   0,   0, -10,
+           -10,   0,   5,  10,  10,   5,   0, -10,
+           -10,   5,   5,  10,  10,   5,   5, -10,
+           -10,   0,  10,  10,  10,  10,   0, -10,
+           -10,  10,  10,  10,  10,  10,  10, -10,
+           -10,   5,   0,   0,   0,   0,   5, -10,
+           -20, -10, -10, -10, -10, -10, -10, -20],
+    'r':  [  0,   0,   0,   0,   0,   0,   0,   0,
+             5,  10,  10,  10,  10,  10,  10,   5,
+            -5,   0,   0,   0,   0,   0,   0,  -5,
+            -5,   0,   0,   0,   0,   0,   0,  -5,
+            -5,   0,   0,   0,   0,   0,   0,  -5,
+            -5,   0,   0,   0,   0,   0,   0,  -5,
+            -5,   0,   0,   0,   0,   0,   0,  -5,
+             0,   0,   0,   5,   5,   0,   0,   0],
+    'q':  [-20, -10, -10,  -5,  -5, -10, -10, -20,
+           -10,   0,   0,   0,   0,   0,   0, -10,
+           -10,   0,   5,   5,   5,   5,   0, -10,
+            -5,   0,   5,   5,   5,   5,   0,  -5,
+             0,   0,   5,   5,   5,   5,   0,  -5,
+           -10,   5,   5,   5,   5,   5,   0, -10,
+           -10,   0,   5,   0,   0,   0,   0, -10,
+           -20, -10, -10,  -5,  -5, -10, -10, -20],
+    'k':  [-30, -40, -40, -50, -50, -40, -40, -30,
+           -30, -40, -40, -50, -50, -40, -40, -30,
+           -30, -40, -40, -50, -50, -40, -40, -30,
+           -30, -40, -40, -50, -50, -40, -40, -30,
+           -20, -30, -30, -40, -40, -30, -30, -20,
+           -10, -20, -20, -20, -20, -20, -20, -10,
+            20,  20,   0,   0,   0,   0,  20,  20,
+            20,  30,  10,   0,   0,  10,  30,  20],
+}
+EGTABLES = dict(MGTABLES)
+EGTABLES['p'] = [  0,   0,   0,   0,   0,   0,   0,   0,
+                  80,  80,  80,  80,  80,  80,  80,  80,
+                  50,  50,  50,  50,  50,  50,  50,  50,
+                  30,  30,  30,  30,  30,  30,  30,  30,
+                  15,  15,  15,  15,  15,  15,  15,  15,
+                   5,   5,   5,   5,   5,   5,   5,   5,
+                   0,   0,   0,   0,   0,   0,   0,   0,
+                   0,   0,   0,   0,   0,   0,   0,   0]
+EGTABLES['k'] = [-50, -40, -30, -20, -20, -30, -40, -50,
+                 -30, -20, -10,   0,   0, -10, -20, -30,
+                 -30, -10,  20,  30,  30,  20, -10, -30,
+                 -30, -10,  30,  40,  40,  30, -10, -30,
+                 -30, -10,  30,  40,  40,  30, -10, -30,
+                 -30, -10,  20,  30,  30,  20, -10, -30,
+                 -30, -30,   0,   0,   0,   0, -30, -30,
+                 -50, -30, -30, -30, -30, -30, -30, -50]
+
+# Each piece's share of the middlegame: 24 with all pieces on the board
+PHASEWEIGHTS = {'p': 0, 'kn': 1, 'b': 1, 'r': 2, 'q': 4, 'k': 0}
+MAXPHASE = 24
+
+def piecesquare(mgvalues, egvalues, mgtables, egtables):
+    """
+    The (middlegame, endgame) terms of every (colour, piecename, square),
+    counted positive for white and negative for black
+    """
+
+    terms = {}
+    for name in PIECEVALUES:
+        for row, col in ALLSQUARES:
+            for colour, index, sign in (('white', (7-row)*8 + col, 1),
+                                        ('black', row*8 + col, -1)):
+                terms[(colour, name, (row, col))] = \
+                    (sign * (mgvalues[name] + mgtables[name][index]),
+                     sign * (egvalues[name] + egtables[name][index]))
+    return terms
+
+PIECESQUARE = piecesquare(MGVALUES, EGVALUES, MGTABLES, EGTABLES)
+
+# Tuned tables written by the tune command, used instead of the ones above
+EVALFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'eval.json')
+
+def loadeval(path):
+    """
+    Evaluate with the values and tables of a JSON file, as written by
+    saveeval. Boards set up before keep the terms of the old tables.
+    """
+
+    global PIECESQUARE
+    with open(path) as tables:
+        tables = json.load(tables)
+    for name, table in [('mgvalues', MGVALUES), ('egvalues', EGVALUES),
+                        ('mgtables', MGTABLES), ('egtables', EGTABLES)]:
+        table.update(tables.get(name, {}))
+    PIECESQUARE = piecesquare(MGVALUES, EGVALUES, MGTABLES, EGTABLES)
+
+def saveeval(path, tables):
+    """ Write {'mgvalues': ..., 'egvalues': ..., 'mgtables': ..., 'egtables': ...} """
+
+    with open(path, 'w') as output:
+        json.dump(tables, output)
+
+if os.path.exists(EVALFILE):
+    loadeval(EVALFILE)
+
+def evaluate(board, player):
+    """
+    Material and piece-square score in centipawns, seen from player's side.
+    The board keeps the terms up to date move by move, so this is O(1).
+    """
+
+    phase = min(board.phase, MAXPHASE)
+    score = int((board.mgscore * phase + board.egscore * (MAXPHASE - phase))
+                / MAXPHASE)
+    return score if player.colour == 'white' else -score
+
+
+PROMOTIONCODES = [None, 'kn', 'b', 'r', 'q']
+
+def encodemove(start, target, promoteto=None):
+    """ Move packed in 16 bits: from square, to square and promotion piece """
+
+    return (start[0]*8 + start[1]) | (target[0]*8 + target[1]) << 6 | \
+           PROMOTIONCODES.index(promoteto) << 12
+
+def decodemove(code):
+    return (ALLSQUARES[code & 63], ALLSQUARES[code >> 6 & 63],
+            PROMOTIONCODES[code >> 12 & 7])
+
+# Bound types of a transposition table score
+EXACT, LOWER, UPPER = 1, 2, 3
+
+
+class TranspositionTable():
+    """
+    Fixed-size hash table of search results. Every bucket has two entries,
+    one kept for the deepest search of the current generation and one that
+    is always replaced. An entry is two 64-bit words, the key xor'ed with
+    the data and the data: score, depth, bound, move and generation.
+    """
+
+    ENTRYSIZE = 16
+
+    def __init__(self, megabytes=16, buffer=None):
+        if buffer is None:
+            buffer = bytearray(self.bytesfor(megabytes))
+        self.buffer = buffer
+        self.words = memoryview(buffer).cast('Q')
+        self.buckets = len(self.words) // 4
+        self.generation = 0
+
+    @classmethod
+    def bytesfor(cls, megabytes):
+        """ Size of a table of megabytes, in whole buckets """
+        return max(1, int(megabytes * 2**20)) // (2*cls.ENTRYSIZE) * 2*cls.ENTRYSIZE
+
+    def newsearch(self):
+        self.generation = (self.generation + 1) & 63
+
+    def probe(self, key):
+        """ (depth, score, bound, move) stored for key, or None """
+
+        words = self.words
+        index = (key % self.buckets) * 4
+        for slot in (index, index+2):
+            data = words[slot+1]
+            if words[slot] ^ data == key:
+                return (data >> 32 & 255, (data & 0xffffffff) - 2**31,
+                        data >> 40 & 3, data >> 42 & 0xffff or None)
+
+    def store(self, key, depth, score, bound, move=None):
+        words = self.words
+        index = (key % self.buckets) * 4
+        data = (score + 2**31) | depth << 32 | bound << 40 | \
+               (move or 0) << 42 | self.generation << 58
+
+        # Depth-preferred slot first, unless it holds a deeper current entry
+        kept = words[index+1]
+        if words[index] ^ kept == key or kept >> 32 & 255 <= depth or \
+           kept >> 58 != self.generation:
+            slot = index
+        else:
+            slot = index + 2
+        words[slot], words[slot+1] = key ^ data, data
+
+    def clear(self):
+        self.buffer[:] = bytes(len(self.buffer))
+
+
+class OpeningBook():
+    """
+    Polyglot-style opening book, a file of 16-byte entries sorted by key:
+    the position's board.zobrist, an encodemove move, its weight and a learn
+    field (big-endian u64, u16, u16, u32). The file is mapped read-only, so
+    opening it costs nothing and processes share the page cache, and a probe
+    is a binary search.
+    """
+
+    ENTRY = struct.Struct('>QHHI')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as book:
+            size = os.fstat(book.fileno()).st_size
+            # mmap refuses to map an empty file
+            self.data = mmap.mmap(book.fileno(), 0, access=mmap.ACCESS_READ) \
+                        if size else b''
+        self.size = size // self.ENTRY.size
+
+    def keyat(self, index):
+        return struct.unpack_from('>Q', self.data, index*self.ENTRY.size)[0]
+
+    def entries(self, key):
+        """ (move, weight) of every book move from the position key """
+
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.keyat(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        moves = []
+        for index in range(low, self.size):
+            entrykey, move, weight, learn = \
+                self.ENTRY.unpack_from(self.data, index*self.ENTRY.size)
+            if entrykey != key:
+                break
+            moves.append((move, weight))
+        return moves
+
+    def choose(self, board, player):
+        """ A book move (start, target, promoteto) picked by weight, or None """
+
+        # Only legal moves, in case of a key collision
+        moves, weights = [], []
+        for code, weight in self.entries(board.zobrist):
+            move = decodemove(code)
+            if weight and move[:2] in player.validmoves:
+                moves.append(move)
+                weights.append(weight)
+        if moves:
+            return player.random.choices(moves, weights)[0]
+
+# Books opened by this process, shared by its players
+OPENBOOKS = {}
+
+def openbook(path):
+    if path not in OPENBOOKS:
+        OPENBOOKS[path] = OpeningBook(path)
+    return OPENBOOKS[path]
+
+
+class GameLog():
+    """
+    Append-only binary record of games. The log file holds every game's
+    start FEN, empty for the initial position, followed by its moves as
+    16-bit encodemove codes. The index, path + '.idx', has a 15-byte entry
+    per game: log offset, FEN length, plies and result (big-endian u64,
+    u16, u32, u8), so game N and its ply K are found in O(1). A log is
+    read only unless opened with record, a missing one raises
+    FileNotFoundError then.
+    """
+
+    ENTRY = struct.Struct('>QHIB')
+    MOVE  = struct.Struct('>H')
+    RESULTS = ['*', '1-0', '0-1', '1/2-1/2']
+
+    def __init__(self, path, record=False):
+        self.path  = path
+        if record:
+            self.log = open(path, 'ab+')
+            # Entries are rewritten as moves come in, so not opened for appending
+            open(path + '.idx', 'ab').close()
+            self.index = open(path + '.idx', 'r+b')
+        else:
+            self.log = open(path, 'rb')
+            self.index = open(path + '.idx', 'rb')
+        # The game begin is recording moves of, if any
+        self.current = None
+
+    def games(self):
+        self.index.flush()
+        return os.fstat(self.index.fileno()).st_size // self.ENTRY.size
+
+    def close(self):
+        self.log.close()
+        self.index.close()
+
+    def begin(self, fen=''):
+        """ Start recording a game, returns its number """
+
+        self.log.seek(0, os.SEEK_END)
+        offset = self.log.tell()
+        fen = fen.encode()
+        self.log.write(fen)
+        self.current = self.games()
+        self.plies = 0
+        self.index.seek(0, os.SEEK_END)
+        self.index.write(self.ENTRY.pack(offset, len(fen), 0, 0))
+        self.flush()
+        return self.current
+
+    def record(self, start, target, promoteto=None):
+        """ Append a move to the game being recorded """
+
+        self.log.write(self.MOVE.pack(encodemove(start, target, promoteto)))
+        self.plies += 1
+        self.setentry(plies=self.plies)
+
+    def finish(self, result):
+        """ Store the result, like '1-0', of the game being recorded """
+
+        self.setentry(result=self.RESULTS.index(result))
+        self.current = None
+
+    def setentry(self, plies=None, result=None):
+        offset, fenlength, oldplies, oldresult = self.entry(self.current)
+        entry = self.ENTRY.pack(offset, fenlength,
+                                oldplies if plies is None else plies,
+                                oldresult if result is None else result)
+        self.index.seek(self.current * self.ENTRY.size)
+        self.index.write(entry)
+        self.flush()
+
+    def flush(self):
+        self.log.flush()
+        self.index.flush()
+
+    def appendgame(self, moves, result='*', fen=''):
+        """ Record a finished game of movestring moves in one go """
+
+        number = self.begin(fen)
+        self.log.write(b''.join(self.MOVE.pack(encodemove(*movefromstring(move)))
+                                for move in moves))
+        self.plies = len(moves)
+        self.setentry(plies=self.plies, result=self.RESULTS.index(result))
+        self.current = None
+        return number
+
+    def entry(self, number):
+        self.flush()
+        self.index.seek(number * self.ENTRY.size)
+        return self.ENTRY.unpack(self.index.read(self.ENTRY.size))
+
+    def result(self, number):
+        return self.RESULTS[self.entry(number)[3]]
+
+    def fen(self, number):
+        offset, fenlength, plies, result = self.entry(number)
+        self.log.seek(offset)
+        return self.log.read(fenlength).decode()
+
+    def moves(self, number, first=0, last=None):
+        """ (start, target, promoteto) of plies first up to last of a game """
+
+        offset, fenlength, plies, result = self.entry(number)
+        last = plies if last is None else min(last, plies)
+        if first >= last:
+            return []
+        self.log.seek(offset + fenlength + first * self.MOVE.size)
+        data = self.log.read((last - first) * self.MOVE.size)
+        return [decodemove(code) for code, in self.MOVE.iter_unpack(data)]
+
+    def replay(self, number, ply=None):
+        """
+        The game and player to move after ply plies of game number, played
+        with domove on a headless board, nothing is drawn
+        """
+
+        game, player = headlessgame(fen=self.fen(number) or None)
+        for start, target, promoteto in self.moves(number, 0, ply):
+            board = game.board
+            if target in board or board[start].piecename == 'p':
+                game.dullmoves = 0
+            else:
+                game.dullmoves += 1
+            player.playmove(board, start, target, promoteto)
+            game.moves.append(movestring(start, target, promoteto))
+            player = player.opponent
+        player.validmoves = list(player.get_validmoves(game.board))
+        return game, player
+
+
+
+# Endgame tablebases: the value of a position for the side to move, packed
+# in a byte as 2 bits of result and 6 bits of moves to mate
+TBDRAW, TBWIN, TBLOSS, TBILLEGAL = 0, 1, 2, 3
+TBMEN = 4
+TBDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tablebases')
+TBORDER = 'KQRBNP'
+TBLETTERS = {name: letter.upper() for letter, name in FENLETTERS.items()}
+TBSETS = ['KQvK', 'KRvK', 'KPvK']
+OTHER = {'white': 'black', 'black': 'white'}
+
+# The move tables with squares numbered row*8 + col
+TBSTEPS = {'k':  [[r*8 + c for r, c in KINGSTEPS[sq]] for sq in ALLSQUARES],
+           'kn': [[r*8 + c for r, c in KNIGHTJUMPS[sq]] for sq in ALLSQUARES]}
+TBRAYS = {name: [[[r*8 + c for r, c in squares] for squares in rays[sq]]
+                 for sq in ALLSQUARES]
+          for name, rays in SLIDERRAYS.items()}
+TBLINES = {name: [set(target for squares in rays[sq] for target in squares)
+                  for sq in range(64)]
+           for name, rays in TBRAYS.items()}
+TBBETWEEN = {(a[0]*8 + a[1], b[0]*8 + b[1]): [r*8 + c for r, c in squares]
+             for (a, b), squares in BETWEEN.items()}
+TBPUSHES = {colour: [[r*8 + c for r, c in pushes[sq]] for sq in ALLSQUARES]
+            for colour, pushes in PAWNPUSHES.items()}
+TBCAPTURES = {colour: [[r*8 + c for r, c in captures[sq]] for sq in ALLSQUARES]
+              for colour, captures in PAWNCAPTURES.items()}
+TBSTARTROW = {'white': 1, 'black': 6}
+
+def tbsorted(letters):
+    return ''.join(sorted(letters, key=TBORDER.index))
+
+def tbmaterial(pieces):
+    """ Material name like 'KRvK' of (colour, piecename, square) pieces """
+
+    return 'v'.join(tbsorted(TBLETTERS[name] for owner, name, sq in pieces
+                             if owner == colour)
+                    for colour in ('white', 'black'))
+
+def tbinsufficient(material):
+    """ True for bare kings or a lone minor piece, always a draw """
+
+    return material.replace('K', '').replace('v', '') in ('', 'B', 'N')
+
+def tbmirror(pieces):
+    """ The same position with the colours swapped and the board flipped """
+
+    return [(OTHER[owner], name, sq ^ 56) for owner, name, sq in pieces]
+
+def tbcanonical(material):
+    """ The orientation of a material set its table is built for """
+
+    whites, blacks = material.split('v')
+    strength = lambda side: [TBORDER.index(letter) for letter in side]
+    if (len(whites), strength(blacks)) < (len(blacks), strength(whites)):
+        return f"{blacks}v{whites}"
+    return material
+
+def tbchildren(material):
+    """ Material sets a capture or a promotion leads to """
+
+    sides = material.split('v')
+    children = set()
+    for mover in (0, 1):
+        own, their = sides[mover], sides[1-mover]
+        owns = [own] + [own.replace('P', letter, 1) for letter in 'QRBN'
+                        if 'P' in own]
+        theirs = [their] + [their[:index] + their[index+1:]
+                            for index, letter in enumerate(their) if letter != 'K']
+        for after in owns:
+            for left in theirs:
+                if (after, left) != (own, their):
+                    pair = [None, None]
+                    pair[mover], pair[1-mover] = tbsorted(after), left
+                    children.add(tbcanonical('v'.join(pair)))
+    return children
+
+
+class Tablebase():
+    """
+    Result and moves to mate of every position of a material set like 'KRvK',
+    white owning the pieces left of the 'v'. Positions are indexed by side to
+    move and the squares of the pieces in the order of the name, a byte each.
+    Tables are made by retrograde analysis, from the mates and from the values
+    of the smaller tables captures and promotions lead to. Castling and en
+    passant are not part of the positions.
+    """
+
+    def __init__(self, material, values=None):
+        self.material = material
+        whites, blacks = material.split('v')
+        self.pieces = [('white', FENLETTERS[letter.lower()]) for letter in whites] + \
+                      [('black', FENLETTERS[letter.lower()]) for letter in blacks]
+        self.men = len(self.pieces)
+        self.kings = {colour: self.pieces.index((colour, 'k'))
+                      for colour in ('white', 'black')}
+        self.values = values
+
+    @classmethod
+    def load(cls, path, material):
+        with open(path, 'rb') as table:
+            return cls(material, mmap.mmap(table.fileno(), 0,
+                                           access=mmap.ACCESS_READ))
+
+    def save(self, path):
+        with open(path, 'wb') as table:
+            table.write(self.values)
+
+    def index(self, side, squares):
+        index = side
+        for sq in squares:
+            index = index*64 + sq
+        return index
+
+    def decode(self, index):
+        squares = [0]*self.men
+        for piece in range(self.men-1, -1, -1):
+            index, squares[piece] = divmod(index, 64)
+        return index, squares
+
+    def value(self, pieces, colour):
+        """ (result, plies to mate) of pieces in this table, colour to move """
+
+        squares, taken = [], set()
+        for owner, name in self.pieces:
+            for other, othername, sq in pieces:
+                if (other, othername) == (owner, name) and sq not in taken:
+                    squares.append(sq)
+                    taken.add(sq)
+                    break
+        entry = self.values[self.index(colour == 'black', squares)]
+        result, moves = entry & 3, entry >> 2
+        # Wins take an odd number of plies, losses an even number
+        return result, 2*moves - 1 if result == TBWIN else 2*moves
+
+    def attacked(self, squares, target, colour, captured=None):
+        """ True if a piece of colour, other than captured, attacks target """
+
+        for piece, (owner, name) in enumerate(self.pieces):
+            if owner != colour or piece == captured:
+                continue
+            sq = squares[piece]
+            if name == 'p':
+                if target in TBCAPTURES[owner][sq]:
+                    return True
+            elif name in TBSTEPS:
+                if target in TBSTEPS[name][sq]:
+                    return True
+            elif target in TBLINES[name][sq]:
+                if not any(between in squares
+                           for between in TBBETWEEN[(sq, target)]):
+                    return True
+        return False
+
+    def legal(self, side, squares):
+        """ No shared squares, no pawns on the back ranks and the side not
+            to move not in check """
+
+        if len(set(squares)) < self.men:
+            return False
+        for piece, (owner, name) in enumerate(self.pieces):
+            if name == 'p' and squares[piece] // 8 in (0, 7):
+                return False
+        colour = 'black' if side else 'white'
+        return not self.attacked(squares, squares[self.kings[OTHER[colour]]],
+                                 colour)
+
+    def moves(self, side, squares):
+        """ Legal moves as (piece, target, captured piece or None) """
+
+        colour = 'black' if side else 'white'
+        occupant = {sq: piece for piece, sq in enumerate(squares)}
+        for piece, (owner, name) in enumerate(self.pieces):
+            if owner != colour:
+                continue
+            sq = squares[piece]
+            if name == 'p':
+                targets = []
+                for target in TBPUSHES[owner][sq]:
+                    if target in occupant:
+                        break
+                    targets.append(target)
+                    if sq // 8 != TBSTARTROW[owner]:
+                        break
+                targets += [target for target in TBCAPTURES[owner][sq]
+                            if target in occupant]
+            elif name in TBSTEPS:
+                targets = TBSTEPS[name][sq]
+            else:
+                targets = []
+                for ray in TBRAYS[name][sq]:
+                    for target in ray:
+                        targets.append(target)
+                        if target in occupant:
+                            break
+
+            for target in targets:
+                captured = occupant.get(target)
+                if captured is not None and self.pieces[captured][0] == colour:
+                    continue
+                after = list(squares)
+                after[piece] = target
+                if not self.attacked(after, after[self.kings[colour]],
+                                     OTHER[colour], captured):
+                    yield piece, target, captured
+
+    def unmoves(self, side, squares):
+        """ Indexes of the positions a quiet move of the side that just
+            moved leads here from """
+
+        mover = 'white' if side else 'black'
+        for piece, (owner, name) in enumerate(self.pieces):
+            if owner != mover:
+                continue
+            sq = squares[piece]
+            origins = []
+            if name == 'p':
+                step = PAWNDIRS[owner] * 8
+                if 1 <= (sq - step) // 8 <= 6 and sq - step not in squares:
+                    origins.append(sq - step)
+                    if (sq - 2*step) // 8 == TBSTARTROW[owner] and \
+                       sq - 2*step not in squares:
+                        origins.append(sq - 2*step)
+            elif name in TBSTEPS:
+                origins = [origin for origin in TBSTEPS[name][sq]
+                           if origin not in squares]
+            else:
+                for ray in TBRAYS[name][sq]:
+                    for origin in ray:
+                        if origin in squares:
+                            break
+                        origins.append(origin)
+
+            for origin in origins:
+                before = list(squares)
+                before[piece] = origin
+                yield self.index(1 - side, before)
+
+    def exits(self, squares, piece, target, captured, colour):
+        """ The positions, as pieces, a capture or promotion leads to """
+
+        pieces = [(owner, name, sq) for index, ((owner, name), sq)
+                  in enumerate(zip(self.pieces, squares))
+                  if index not in (piece, captured)]
+        owner, name = self.pieces[piece]
+        promotions = PROMOTIONS if name == 'p' and target // 8 in (0, 7) \
+                     else [name]
+        return [pieces + [(owner, promoteto, target)] for promoteto in promotions]
+
+    def generate(self, probe):
+        """ Fill the table, probe(pieces, colour) gives the smaller tables """
+
+        size = 2 * 64**self.men
+        result = bytearray(size)
+        final = bytearray(size)
+        # Quiet moves not yet known to lose
+        remaining = bytearray(size)
+        # Plies a loss lasts at least, set by captures into lost endings
+        lossplies = bytearray(size)
+        # Set when a capture or promotion keeps a draw or better
+        saved = bytearray(size)
+        # Positions to settle by plies to mate, as index*4 + result
+        levels = collections.defaultdict(lambda: array.array('Q'))
+
+        for index in range(size):
+            side, squares = self.decode(index)
+            if not self.legal(side, squares):
+                result[index], final[index] = TBILLEGAL, 1
+                continue
+            colour = 'black' if side else 'white'
+            moves = quiet = 0
+            for piece, target, captured in self.moves(side, squares):
+                moves += 1
+                if captured is None and (self.pieces[piece][1] != 'p' or
+                                         target // 8 not in (0, 7)):
+                    quiet += 1
+                    continue
+                for pieces in self.exits(squares, piece, target, captured, colour):
+                    exitresult, plies = probe(pieces, OTHER[colour])
+                    if exitresult == TBLOSS:
+                        levels[plies+1].append(index*4 + TBWIN)
+                        saved[index] = 1
+                    elif exitresult == TBDRAW:
+                        saved[index] = 1
+                    else:
+                        lossplies[index] = max(lossplies[index], plies+1)
+            remaining[index] = quiet
+            if not moves:
+                if self.attacked(squares, squares[self.kings[colour]],
+                                 OTHER[colour]):
+                    levels[0].append(index*4 + TBLOSS)
+                else:
+                    final[index] = 1
+            elif not quiet and not saved[index]:
+                levels[lossplies[index]].append(index*4 + TBLOSS)
+
+        # Positions are settled in order of plies to mate, so the first win
+        # found is the fastest and a loss is settled by its slowest move
+        level = 0
+        while levels:
+            for entry in levels.pop(level, []):
+                index, kind = entry >> 2, entry & 3
+                if final[index]:
+                    continue
+                final[index] = 1
+                result[index] = kind | min((level + 1) // 2, 63) << 2
+                for before in self.unmoves(*self.decode(index)):
+                    if final[before]:
+                        continue
+                    if kind == TBLOSS:
+                        levels[level+1].append(before*4 + TBWIN)
+                    else:
+                        remaining[before] -= 1
+                        if not remaining[before] and not saved[before]:
+                            levels[max(level+1, lossplies[before])].append(
+                                before*4 + TBLOSS)
+            level += 1
+        self.values = result
+
+# Tables by material, loaded on first use, None if not built
+TABLEBASES = {}
+
+def tablebase(material):
+    if material not in TABLEBASES:
+        path = os.path.join(TBDIR, f"{material}.tb")
+        TABLEBASES[material] = Tablebase.load(path, material) \
+                               if os.path.exists(path) else None
+    return TABLEBASES[material]
+
+def tbprobe(pieces, colour):
+    """ (result, plies to mate) of (colour, piecename, square) pieces with
+        colour to move, None without a table """
+
+    material = tbmaterial(pieces)
+    if tbinsufficient(material):
+        return TBDRAW, 0
+    table = tablebase(material)
+    if table:
+        return table.value(pieces, colour)
+    table = tablebase(tbmaterial(tbmirror(pieces)))
+    if table:
+        return table.value(tbmirror(pieces), OTHER[colour])
+
+def probetablebase(board, player):
+    """ (result, plies to mate) of the board with player to move, or None """
+
+    if len(board) > TBMEN or board.castling:
+        return None
+    if board.epkey:
+        # Tables know no en passant, it only matters if a pawn can take
+        col, row = EPKEYS.index(board.epkey), player.enpassantrow
+        for side in (col-1, col+1):
+            if (row, side) in board and board[(row, side)].colour == player.colour \
+               and board[(row, side)].piecename == 'p':
+                return None
+    return tbprobe([(board[pos].colour, board[pos].piecename, pos[0]*8 + pos[1])
+                    for pos in board], player.colour)
+
+def buildtablebase(material):
+    """ Build the table of material after the ones it depends on, returns
+        the names built """
+
+    material = tbcanonical(material)
+    built = []
+    for child in sorted(tbchildren(material)):
+        if not tbinsufficient(child) and not tablebase(child):
+            built += buildtablebase(child)
+    table = Tablebase(material)
+    table.generate(tbprobe)
+    os.makedirs(TBDIR, exist_ok=True)
+    table.save(os.path.join(TBDIR, f"{material}.tb"))
+    TABLEBASES[material] = table
+    return built + [material]
+
+
+class Search():
+    """
+    Negamax alpha-beta with iterative deepening, stopping when the time
+    (seconds) or node budget runs out. Moves are made and taken back on the
+    board itself through Player.playmove/takeback.
+    """
+
+    # False when a ParallelSearch has started the table's generation
+    fresh  = True
+    # Set by another process to stop this search
+    signal = None
+
+    def __init__(self, board, player, movetime=None, maxnodes=None,
+                 maxdepth=None, table=None, startdepth=1):
+        self.board    = board
+        self.table    = table
+        self.player   = player
+        self.movetime = movetime
+        self.maxnodes = maxnodes
+        self.maxdepth = maxdepth or 64
+        self.startdepth = startdepth
+        self.nodes    = 0
+        self.stopped  = False
+        self.bestmove = None
+        # Score and depth of the last finished iteration
+        self.score    = None
+        self.finished = 0
+        # Root moves searched, as 'e2e4' strings, None for all (searchmoves)
+        self.rootmoves = None
+
+    def stop(self):
+        self.stopped = True
+
+    def outofbudget(self):
+        if self.maxnodes and self.nodes >= self.maxnodes:
+            return True
+        if self.movetime and time.perf_counter() >= self.deadline:
+            return True
+        if self.signal is not None and self.signal.is_set():
+            return True
+        return False
+
+    def countnode(self):
+        self.nodes += 1
+        if self.nodes & 255 == 0 and self.depth > 1 and self.outofbudget():
+            self.stopped = True
+
+    def run(self):
+        """ Search until the budget is spent, returns the best (start, target) """
+
+        for depth, score, move in self.iterate():
+            pass
+        return self.bestmove[:2]
+
+    def iterate(self):
+        """ Deepen one ply at a time, yields (depth, score, move) per finished depth """
+
+        self.deadline = time.perf_counter() + (self.movetime or 0)
+        if self.table and self.fresh:
+            self.table.newsearch()
+        self.depth = self.startdepth
+        # The first depth is always searched, stopped or not, so there is a move
+        while self.depth <= self.maxdepth and \
+              (not self.stopped or self.depth == 1):
+            score, move = self.searchroot(self.depth)
+            # An interrupted iteration is incomplete, keep the previous move
+            if self.stopped and self.depth > 1:
+                break
+            self.bestmove, self.score, self.finished = move, score, self.depth
+            yield self.depth, score, move
+            if abs(score) >= MATE - 64 or self.outofbudget():
+                break
+            self.depth += 1
+
+    def searchroot(self, depth):
+        player, board = self.player, self.board
+        alpha, beta = -MATE, MATE
+        bestmove = None
+        for start, target, promoteto in self.ordered(player, self.bestmove):
+            if self.rootmoves and \
+               movestring(start, target, promoteto) not in self.rootmoves and \
+               movestring(start, target) not in self.rootmoves:
+                continue
+            player.playmove(board, start, target, promoteto)
+            score = -self.alphabeta(player.opponent, depth-1, -beta, -alpha, 1)
+            player.takeback(board, start, target, promoteto)
+            if self.stopped and depth > 1:
+                break
+            if bestmove is None or score > alpha:
+                alpha, bestmove = score, (start, target, promoteto)
+        return alpha, bestmove
+
+    def alphabeta(self, player, depth, alpha, beta, ply):
+        if depth <= 0:
+            return self.quiesce(player, alpha, beta, ply)
+
+        self.countnode()
+        board = self.board
+        table = self.table
+
+        # A position seen before, in the game or on this line, is a draw
+        if board.history[board.zobrist] > 1:
+            return 0
+
+        hashmove = None
+        if table:
+            entry = table.probe(board.zobrist)
+            if entry:
+                entrydepth, score, bound, hashmove = entry
+                score = fromtable(score, ply)
+                if entrydepth >= depth and (bound == EXACT or
+                   bound == LOWER and score >= beta or
+                   bound == UPPER and score <= alpha):
+                    return score
+                if hashmove:
+                    hashmove = decodemove(hashmove)
+
+        if len(board) <= TBMEN:
+            value = probetablebase(board, player)
+            if value:
+                result, plies = value
+                if result == TBWIN:
+                    return MATE - ply - plies
+                return -MATE + ply + plies if result == TBLOSS else 0
+
+        originalalpha, bestmove, searched = alpha, None, False
+        for start, target, promoteto in self.ordered(player, hashmove):
+            searched = True
+            player.playmove(board, start, target, promoteto)
+            score = -self.alphabeta(player.opponent, depth-1, -beta, -alpha, ply+1)
+            player.takeback(board, start, target, promoteto)
+            if self.stopped:
+                return 0
+            if score > alpha:
+                alpha, bestmove = score, (start, target, promoteto)
+                if alpha >= beta:
+                    break
+
+        if not searched:
+            return -MATE + ply if player.isincheck(board) else 0
+
+        if table:
+            if alpha >= beta:
+                bound = LOWER
+            else:
+                bound = EXACT if alpha > originalalpha else UPPER
+            table.store(board.zobrist, depth, totable(alpha, ply), bound,
+                        bestmove and encodemove(*bestmove))
+        return alpha
+
+    def quiesce(self, player, alpha, beta, ply):
+        """ Search captures only, until the position is quiet. Captures
+            losing material by see are not searched at all """
+
+        self.countnode()
+        board = self.board
+        standpat = evaluate(board, player)
+        if standpat >= beta:
+            return standpat
+        alpha = max(alpha, standpat)
+
+        for start, target, promoteto in self.ordered(player, capturesonly=True):
+            player.playmove(board, start, target, promoteto)
+            score = -self.quiesce(player.opponent, -beta, -alpha, ply+1)
+            player.takeback(board, start, target, promoteto)
+            if self.stopped:
+                return 0
+            if score > alpha:
+                alpha = score
+                if alpha >= beta:
+                    break
+        return alpha
+
+    def ordered(self, player, first=None, capturesonly=False):
+        """
+        Legal moves as (start, target, promoteto), likely best first: the
+        hash move, then captures by MVV-LVA, promotions, quiet moves and
+        captures losing material, each stage generated only when the one
+        before did not cut off. With capturesonly the losing captures are
+        pruned.
+        """
+
+        board = self.board
+        if first and self.islegal(player, first):
+            yield first
+        for start, target in player.stagedmoves(board, not capturesonly):
+            if player.ispromotion(board, start, target):
+                for move in ((start, target, 'q'), (start, target, 'kn')):
+                    if move != first:
+                        yield move
+            elif (start, target, None) != first:
+                yield (start, target, None)
+
+    def islegal(self, player, move):
+        """ Whether a hash move, maybe from a colliding key, can be played """
+
+        board = self.board
+        start, target, promoteto = move
+        if start not in board or board[start].colour != player.colour:
+            return False
+        if (promoteto is not None) != player.ispromotion(board, start, target):
+            return False
+        moves = player.piecemoves(board, start)
+        return (start, target) in player.get_validmoves(board, moves)
+
+
+# The table, stop signal and players of a ParallelSearch helper process
+HELPER = {}
+
+def helperinit(memoryname, megabytes, signal):
+    memory = shared_memory.SharedMemory(name=memoryname)
+    size = TranspositionTable.bytesfor(megabytes)
+    HELPER.update(memory=memory, signal=signal,
+                  table=TranspositionTable(megabytes, memory.buf[:size]))
+
+def helpersearch(job):
+    """ One helper's search, returns (depth, score, move, nodes) """
+
+    snapshot, colour, playedturns, maxdepth, startdepth, generation = job
+    board = pickle.loads(snapshot)
+    game, player = headlessgame()
+    for other in game.players.values():
+        other.playedturns = playedturns[other.colour]
+    table = HELPER['table']
+    table.generation = generation
+    search = Search(board, game.players[colour], None, None, maxdepth, table,
+                    startdepth)
+    search.fresh, search.signal = False, HELPER['signal']
+    depth, score, move = 0, None, None
+    for depth, score, move in search.iterate():
+        pass
+    return depth, score, move, search.nodes
+
+
+class ParallelSearch():
+    """
+    Lazy SMP: helper processes search the same root position as the main
+    search, every other one starting a ply deeper, all sharing one
+    transposition table in shared memory. The main search keeps the budget
+    and stops the helpers, the deepest finished result gives the move.
+    """
+
+    def __init__(self, processes, megabytes=16):
+        size = TranspositionTable.bytesfor(megabytes)
+        self.memory = shared_memory.SharedMemory(create=True, size=size)
+        self.table = TranspositionTable(megabytes, self.memory.buf[:size])
+        self.signal = multiprocessing.Event()
+        self.pool = multiprocessing.Pool(processes - 1, helperinit,
+                                         (self.memory.name, megabytes, self.signal))
+        self.helpers = processes - 1
+        self.nodes = 0
+        # The pool and the shared memory go with the last reference
+        weakref.finalize(self, ParallelSearch.release, self.pool, self.memory,
+                         self.table)
+
+    @staticmethod
+    def release(pool, memory, table):
+        pool.terminate()
+        # The memory can only be closed once the table's views are gone
+        table.words.release()
+        table.buffer.release()
+        memory.close()
+        memory.unlink()
+
+    def start(self, board, player, maxdepth=None):
+        """ Set the helpers searching, returns the main Search to iterate """
+
+        self.signal.clear()
+        self.table.newsearch()
+        playedturns = {player.colour: player.playedturns,
+                       player.opponent.colour: player.opponent.playedturns}
+        # Pickled now, the pool would send the board while it is searched
+        snapshot = pickle.dumps(board)
+        jobs = [(snapshot, player.colour, playedturns, maxdepth, 1 + (helper+1) % 2,
+                 self.table.generation) for helper in range(self.helpers)]
+        self.pending = self.pool.map_async(helpersearch, jobs)
+
+    def finish(self, search):
+        """ Stop the helpers once search is done, returns the deepest
+            finished (depth, score, move) """
+
+        self.signal.set()
+        best = (search.finished, search.score, search.bestmove)
+        self.nodes = search.nodes
+        for depth, score, move, nodes in self.pending.get():
+            self.nodes += nodes
+            if move and depth > best[0]:
+                best = (depth, score, move)
+        return best
+
+    def run(self, board, player, movetime=None, maxnodes=None, maxdepth=None):
+        """ Best (start, target, promoteto) within the main search's budget """
+
+        self.start(board, player, maxdepth)
+        search = Search(board, player, movetime, maxnodes, maxdepth, self.table)
+        search.fresh = False
+        for depth, score, move in search.iterate():
+            pass
+        return self.finish(search)[2]
+
+
+# Proof and disproof numbers of a solved node, and PNINFINITY caps the sums
+PNINFINITY = 1 << 40
+# Bytes a MateSolver node takes, measured, for caps given in megabytes
+PNNODEBYTES = 176
+
+class MateSolver():
+    """
+    Proof-number search for a forced mate in at most N moves. Attacker
+    nodes are proved by one mating child, defender nodes by all of theirs,
+    and the most-proving leaf is expanded next, so forcing lines are read
+    deep while the rest of the tree stays one ply. A node is a list
+    [move, proof, disproof, children], children None until expanded.
+    Refuted attacker moves are dropped as they are found, and the last
+    attacker move only tries checks. Stops, undecided, at maxnodes.
+    """
+
+    def __init__(self, board, player, maxnodes=1 << 20):
+        self.board = board
+        self.player = player
+        self.maxnodes = maxnodes
+        # Nodes of the current tree, and created over all trees
+        self.nodes = 0
+        self.created = 0
+
+    def solve(self, moves):
+        """ The mating line as 'e2e4' strings, [] if there is no mate in
+            moves or fewer, None if the node cap was hit first """
+
+        root = [None, 1, 1, None]
+        self.nodes = 0
+        while root[1] and root[2] and self.nodes < self.maxnodes:
+            self.descend(root, self.player, True, 2*moves - 1)
+        if root[1] == 0:
+            return self.line(root, self.player, True)
+        return [] if root[2] == 0 else None
+
+    def descend(self, node, player, attacking, plies):
+        """ Expand the most-proving leaf below node and update the numbers
+            on the way back, player is to move in node """
+
+        children = node[3]
+        if children is None:
+            self.expand(node, player, attacking, plies)
+        else:
+            # The attacker needs one proof, the defender one disproof
+            index = 1 if attacking else 2
+            child = min(children, key=lambda child: child[index])
+            start, target, promoteto = child[0]
+            player.playmove(self.board, start, target, promoteto)
+            self.descend(child, player.opponent, not attacking, plies-1)
+            player.takeback(self.board, start, target, promoteto)
+        self.update(node, attacking)
+
+    def expand(self, node, player, attacking, plies):
+        board = self.board
+        opponent = player.opponent
+        children = []
+        for start, target in list(player.get_validmoves(board)):
+            promotions = PROMOTIONS if player.ispromotion(board, start, target) \
+                         else [None]
+            for promoteto in promotions:
+                player.playmove(board, start, target, promoteto)
+                if attacking and plies == 1 and not opponent.isincheck(board):
+                    child = None
+                else:
+                    child = self.newnode((start, target, promoteto), opponent,
+                                         not attacking, plies-1)
+                player.takeback(board, start, target, promoteto)
+                # A refuted attacker move can not help any more
+                if child and not (attacking and child[2] == 0):
+                    children.append(child)
+        self.nodes += len(children)
+        self.created += len(children)
+        node[3] = children
+
+    def newnode(self, move, player, attacking, plies):
+        """ Leaf after move, player to move. A defender leaf is numbered by
+            its replies, which also tell mate and stalemate, an attacker
+            leaf is left to its expansion """
+
+        board = self.board
+        if attacking:
+            if plies == 0 or board.insufficient():
+                return [move, PNINFINITY, 0, None]
+            return [move, 1, 1, None]
+        replies = sum(1 for reply in player.get_validmoves(board))
+        if not replies:
+            if player.isincheck(board):
+                return [move, 0, PNINFINITY, None]
+            return [move, PNINFINITY, 0, None]
+        if plies == 0:
+            return [move, PNINFINITY, 0, None]
+        return [move, replies, 1, None]
+
+    def update(self, node, attacking):
+        children = node[3]
+        if attacking:
+            node[1] = min((child[1] for child in children), default=PNINFINITY)
+            node[2] = min(sum(child[2] for child in children), PNINFINITY)
+        else:
+            node[1] = min(sum(child[1] for child in children), PNINFINITY)
+            node[2] = min((child[2] for child in children), default=PNINFINITY)
+
+    def line(self, node, player, attacking):
+        """ Main line of a proved node: the quickest mate, the longest defence """
+
+        children = node[3]
+        if not children:
+            return []
+        lines = []
+        for child in children:
+            if child[1] == 0:
+                start, target, promoteto = child[0]
+                player.playmove(self.board, start, target, promoteto)
+                rest = self.line(child, player.opponent, not attacking)
+                player.takeback(self.board, start, target, promoteto)
+                lines.append([movestring(start, target, promoteto)] + rest)
+        return (min if attacking else max)(lines, key=len)
+
+
 def clear():
     if os.name in ('nt','dos'):
         subprocess.call("cls")
@@ -625,7 +2908,8 @@ def clear():
     else:
         print(("\n") * 120)
 
-def newgame():
+def newgame(record=None):
+    """ Play one interactive game, recorded into the GameLog file record """
 
     clear()
 
@@ -645,6 +2929,10 @@ def newgame():
     playerb.set_opponent(playera)
 
     game = Game(playera, playerb)
+    game.renderer = TerminalRenderer()
+    if record:
+        game.log = GameLog(record, record=True)
+        game.log.begin()
 
     infostring = (
     f"Very well, {playera.name} and {playerb.name}, let's play.\n"
@@ -668,28 +2956,1727 @@ def newgame():
         pass
 
     else:
+        if game.log:
+            game.log.finish(RESULTS[player.colour] if result == 2
+                            else '1/2-1/2')
         print(game.end(player, result))
         input("\n\nPress any key to continue")
 
+    finally:
+        if game.log:
+            game.log.close()
+
+# Seconds the computer may think per move in interactive games
+AIMOVETIME = 2.0
+# Processes the computer searches with, see ParallelSearch
+AITHREADS = 1
+# Opening book of interactive games, used if it exists
+BOOKFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'book.bin')
+
+def interactivebook():
+    return BOOKFILE if os.path.exists(BOOKFILE) else None
+
 def getplayers():
 
     ainames = ['chesschick','foxysquare']
 
     name1 = input("\nPlayer A (white): ")
     if not name1:
-        playera = Player('white', 'AI', ainames[0])
+        playera = Player('white', 'AI', ainames[0], movetime=AIMOVETIME,
+                         book=interactivebook(), threads=AITHREADS)
     else:
         playera = Player('white', 'human', name1)
 
     name2 = input("\nPlayer B (black): ")
     if not name2:
-        playerb = Player('black', 'AI', ainames[1])
+        playerb = Player('black', 'AI', ainames[1], movetime=AIMOVETIME,
+                         book=interactivebook(), threads=AITHREADS)
     else:
         playerb = Player('black', 'human', name2)
 
     return playera, playerb
 
-def main():
+def movestring(start, target, promoteto=None):
+    """ The 'a2b3' form of a move, the reverse of Player.getposition """
+
+    move = f"{chr(start[1]+97)}{start[0]+1}{chr(target[1]+97)}{target[0]+1}"
+    if promoteto:
+        move += 'n' if promoteto == 'kn' else promoteto
+    return move
+
+# Moves in the form movestring writes them
+MOVEPATTERN = re.compile(r'^[a-h][1-8][a-h][1-8][nbrq]?$')
+
+def movefromstring(move):
+    """ (start, target, promoteto) of a movestring like e7e8q """
+
+    start  = (int(move[1])-1, ord(move[0])-97)
+    target = (int(move[3])-1, ord(move[2])-97)
+    return start, target, FENLETTERS[move[4]] if len(move) > 4 else None
+
+# Reference positions with their known perft node counts by depth
+PERFTPOSITIONS = {
+    'startpos': ('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+                 [20, 400, 8902, 197281, 4865609]),
+    'kiwipete': ('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R '
+                 'w KQkq - 0 1', [48, 2039, 97862, 4085603]),
+    'enpassant': ('8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+                  [14, 191, 2812, 43238, 674624]),
+    'castling': ('r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 '
+                 'w kq - 0 1', [6, 264, 9467, 422333]),
+    'mirrored': ('r2q1rk1/pP1p2pp/Q4n2/bbp1p3/Np6/1B3NBn/pPPP1PPP/R3K2R '
+                 'b KQ - 0 1', [6, 264, 9467, 422333]),
+    'promotion': ('rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+                  [44, 1486, 62379, 2103487]),
+    'middlegame': ('r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/'
+                   'R4RK1 w - - 0 10', [46, 2079, 89890, 3894594]),
+}
+
+def perft(board, player, depth, verify=False):
+    """ Number of move sequences depth plies long, promotions counted per
+        piece. With verify every node is checked, the leaves too, so the
+        last ply is played instead of counted """
+
+    if verify:
+        verifyboard(board, player)
+    if depth == 0:
+        return 1
+    nodes = 0
+    for start, target in list(player.get_validmoves(board)):
+        promotions = PROMOTIONS if player.ispromotion(board, start, target) \
+                     else [None]
+        if depth == 1 and not verify:
+            nodes += len(promotions)
+            continue
+        for promoteto in promotions:
+            player.playmove(board, start, target, promoteto)
+            nodes += perft(board, player.opponent, depth-1, verify)
+            player.takeback(board, start, target, promoteto)
+    return nodes
+
+def perftdivide(board, player, depth, verify=False):
+    """ Perft split up by root move, as {'a2b3': nodes} """
+
+    divide = {}
+    for start, target in list(player.get_validmoves(board)):
+        promotions = PROMOTIONS if player.ispromotion(board, start, target) \
+                     else [None]
+        for promoteto in promotions:
+            player.playmove(board, start, target, promoteto)
+            nodes = perft(board, player.opponent, depth-1, verify) \
+                    if depth > 1 or verify else 1
+            player.takeback(board, start, target, promoteto)
+            divide[movestring(start, target, promoteto)] = nodes
+    return divide
+
+def verifyboard(board, player):
+    """ Check every incrementally kept term against a recount, player to move """
+
+    assert board.zobrist == board.computekey(player.colour)
+    board.verifyattacks()
+    board.verifyscores()
+    if hasattr(board, 'verify'):
+        board.verify()
+
+def headlessgame(backend='dict', fen=None, seed=None, **budget):
+    """ Game between two silent players, returns the game and player to move """
+
+    playera = Player('white', 'AI', 'white', f"{seed}-white", **budget)
+    playerb = Player('black', 'AI', 'black', f"{seed}-black", **budget)
+    playera.set_opponent(playerb)
+    playerb.set_opponent(playera)
+    game = Game(playera, playerb, backend)
+    if fen:
+        return game, game.setfen(fen)
+    return game, playera
+
+def runperft(args):
+    """ The perft command, returns the number of mismatching counts """
+
+    if args.fen:
+        positions = [('fen', args.fen, [])]
+    elif args.position:
+        positions = [(args.position,) + PERFTPOSITIONS[args.position]]
+    else:
+        positions = [(name,) + PERFTPOSITIONS[name] for name in PERFTPOSITIONS]
+
+    failures = 0
+    for name, fen, expected in positions:
+        game, player = headlessgame(args.backend, fen)
+        # The suite stops each position at a depth plain Python gets through
+        depth = args.depth or min(len(expected), 4 if name == 'startpos' else 3)
+
+        begin = time.perf_counter()
+        if args.divide:
+            divide = perftdivide(game.board, player, depth, args.verify)
+            for move in sorted(divide):
+                print(f"{move}: {divide[move]}")
+            nodes = sum(divide.values())
+        else:
+            nodes = perft(game.board, player, depth, args.verify)
+        elapsed = time.perf_counter() - begin
+
+        verdict = ''
+        if depth <= len(expected):
+            ok = nodes == expected[depth-1]
+            failures += not ok
+            verdict = 'ok' if ok else f'FAILED, expected {expected[depth-1]}'
+        print(f"{name:12s} depth {depth}  nodes {nodes:10d}  "
+              f"{elapsed:8.2f}s  {nodes/max(elapsed, 1e-9):10.0f} nodes/s  {verdict}")
+
+    return failures
+
+RESULTS = {'white': '0-1', 'black': '1-0'}
+
+def selfplaygame(job):
+    """ Play one silent AI game, returns its record for the JSONL output """
+
+    index, seed, backend, maxplies, budget, stats = job
+    begin = time.perf_counter()
+    game, player = headlessgame(backend, seed=seed, **budget)
+    result, player = game.autoplay(player, maxplies)
+
+    if result == 2:
+        outcome, reason = RESULTS[player.colour], 'checkmate'
+    elif result == 1:
+        outcome, reason = '1/2-1/2', 'draw'
+    else:
+        outcome, reason = '*', 'ply limit'
+
+    record = {'game': index, 'seed': seed, 'result': outcome, 'reason': reason,
+              'plies': len(game.moves), 'seconds': time.perf_counter() - begin,
+              'moves': game.moves}
+    if stats:
+        record['stats'] = game.stats.summary()
+    return record
+
+def runselfplay(args):
+    """ The selfplay command, streams one JSON line per finished game """
+
+    budget = {'movetime': args.movetime, 'maxnodes': args.nodes,
+              'maxdepth': args.depth, 'book': args.book}
+    jobs = [(index, args.seed + index, args.backend, args.maxplies, budget,
+             args.stats) for index in range(args.games)]
+    output = open(args.output, 'w') if args.output else sys.stdout
+    # Games are logged as they finish, the workers' games would interleave
+    log = GameLog(args.record, record=True) if args.record else None
+
+    begin, plies = time.perf_counter(), 0
+    if args.workers == 1:
+        records = map(selfplaygame, jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(args.workers)
+        records = pool.imap_unordered(selfplaygame, jobs)
+
+    try:
+        for record in records:
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+            if log:
+                log.appendgame(record['moves'], record['result'])
+            plies += record['plies']
+    finally:
+        if pool:
+            pool.terminate()
+        if output is not sys.stdout:
+            output.close()
+        if log:
+            log.close()
+
+    elapsed = time.perf_counter() - begin
+    print(f"{args.games} games, {plies} plies in {elapsed:.2f}s "
+          f"({args.games/elapsed:.2f} games/s, {plies/elapsed:.0f} plies/s)",
+          file=sys.stderr)
+
+def readpgn(lines):
+    """ Games of a PGN stream as (tags, movetext), one game in memory at a time """
+
+    tags, movetext = {}, []
+    for line in lines:
+        line = line.split(';')[0].strip()
+        if line.startswith('['):
+            # A tag after the moves starts the next game
+            if movetext:
+                yield tags, ' '.join(movetext)
+                tags, movetext = {}, []
+            match = re.match(r'\[(\w+)\s+"(.*)"\]', line)
+            if match:
+                tags[match.group(1)] = match.group(2)
+        elif line and not line.startswith('%'):
+            movetext.append(line)
+    if tags or movetext:
+        yield tags, ' '.join(movetext)
+
+def santokens(movetext):
+    """ The SAN moves of a PGN movetext, without comments and variations """
+
+    movetext = re.sub(r'\{[^}]*\}', ' ', movetext)
+    variations = 0
+    for token in re.findall(r'\(|\)|[^\s()]+', movetext):
+        if token == '(':
+            variations += 1
+        elif token == ')':
+            variations -= 1
+        elif not variations:
+            token = re.sub(r'^\d+\.+', '', token)
+            if token and not token.startswith('$') and \
+               token not in ('1-0', '0-1', '1/2-1/2', '*'):
+                yield token
+
+def parsesan(board, player, san):
+    """ (start, target, promoteto) of a SAN move among player's validmoves """
+
+    move = san.rstrip('+#!?')
+    if move in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+        kingpos = player.kingpos(board)
+        step = 2 if len(move) == 3 else -2
+        target = (kingpos[0], kingpos[1]+step)
+        if (kingpos, target) in player.validmoves:
+            return kingpos, target, None
+        raise ValueError(f"Illegal move {san}")
+
+    # Every malformed token is a ValueError, so a caller skips it like an
+    # illegal move
+    promoteto = None
+    if '=' in move:
+        move, _, letter = move.partition('=')
+        if len(letter) != 1 or letter.lower() not in 'qrbn':
+            raise ValueError(f"Unreadable move {san}")
+        promoteto = FENLETTERS[letter.lower()]
+    elif move and move[-1] in 'QRBN':
+        move, promoteto = move[:-1], FENLETTERS[move[-1].lower()]
+    if not move:
+        raise ValueError(f"Unreadable move {san}")
+
+    piecename = FENLETTERS[move[0].lower()] if move[0] in 'KQRBN' else 'p'
+    if piecename != 'p':
+        move = move[1:]
+    move = move.replace('x', '').replace('-', '')
+    if len(move) < 2 or move[-2] not in 'abcdefgh' or move[-1] not in '12345678':
+        raise ValueError(f"Unreadable move {san}")
+    target = (int(move[-1])-1, ord(move[-2])-97)
+    hint = move[:-2]
+    if any(c not in 'abcdefgh12345678' for c in hint):
+        raise ValueError(f"Unreadable move {san}")
+
+    candidates = [start for start, to in player.validmoves if to == target and
+                  board[start].piecename == piecename and
+                  all(start[1] == ord(c)-97 if c in 'abcdefgh' else
+                      start[0] == int(c)-1 for c in hint)]
+    if len(candidates) != 1:
+        raise ValueError(f"Illegal or ambiguous move {san}")
+    if piecename == 'p' and target[0] in (0, 7):
+        promoteto = promoteto or 'q'
+    return candidates[0], target, promoteto
+
+def readepd(lines):
+    """ Positions of an EPD stream as (fen, {opcode: operand}) """
+
+    for line in lines:
+        fields = line.strip().split(None, 4)
+        if len(fields) < 4:
+            continue
+        operations = {}
+        for operation in (fields[4] if len(fields) > 4 else '').split(';'):
+            operation = operation.strip().split(None, 1)
+            if operation:
+                operations[operation[0]] = \
+                    operation[1].strip('"') if len(operation) > 1 else ''
+        yield ' '.join(fields[:4]) + ' 0 1', operations
+
+def positionstatus(game, player, evaldepth=None):
+    """ Legal move count, check/mate/draw status and optional search score """
+
+    board = game.board
+    mate = bool(player.ischeckmate(board))
+    draw = not mate and bool(player.reacheddraw(board, game.dullmoves))
+    status = {'fen': game.getfen(player), 'legalmoves': len(player.validmoves),
+              'check': bool(player.isincheck(board)), 'mate': mate, 'draw': draw}
+    if evaldepth and not mate and not draw:
+        search = Search(board, player, maxdepth=evaldepth)
+        for depth, score, move in search.iterate():
+            status['eval'] = score
+            status['bestmove'] = movestring(*move)
+    return status
+
+STARTFEN = PERFTPOSITIONS['startpos'][0]
+
+class Position():
+    """
+    A position for programs that embed the engine, with no terminal and
+    no input: set it up from a FEN and/or moves, then ask for its legal
+    moves and status or apply more moves. Moves are read in the 'e2e4'
+    ('e7e8q') form or as SAN and returned in the first. A bad FEN or an
+    illegal move raises ValueError.
+    """
+
+    def __init__(self, fen=None, moves=()):
+        self.game, self.player = headlessgame()
+        self.reset(fen, moves)
+
+    def reset(self, fen=None, moves=()):
+        """ Set up another position, reusing the game and players """
+
+        try:
+            self.player = self.game.setfen(fen or STARTFEN)
+        except (ValueError, IndexError, KeyError, AttributeError):
+            raise ValueError(f"Bad FEN {fen}")
+        if len(self.game.board.kings) != 2:
+            raise ValueError(f"Bad FEN {fen}, a king is missing")
+        self.game.moves = []
+        self.player.validmoves = list(self.player.get_validmoves(self.game.board))
+        for move in moves:
+            self.apply(move)
+        return self
+
+    def fen(self):
+        return self.game.getfen(self.player)
+
+    def legalmoves(self):
+        """ The legal moves, a promotion once for every piece """
+
+        moves = []
+        for start, target in self.player.validmoves:
+            if self.player.ispromotion(self.game.board, start, target):
+                moves += [movestring(start, target, piece) for piece in PROMOTIONS]
+            else:
+                moves.append(movestring(start, target))
+        return sorted(moves)
+
+    def status(self):
+        """ fen, legalmoves (the count), check, mate and draw """
+        return positionstatus(self.game, self.player)
+
+    def apply(self, move):
+        """ Play a move, returns it in the 'e2e4' form """
+
+        player, board = self.player, self.game.board
+        if MOVEPATTERN.match(move):
+            start, target, promoteto = movefromstring(move)
+            if (start, target) not in player.validmoves:
+                raise ValueError(f"Illegal move {move}")
+            if player.ispromotion(board, start, target):
+                promoteto = promoteto or 'q'
+            else:
+                promoteto = None
+        else:
+            start, target, promoteto = parsesan(board, player, move)
+        self.player = self.game.makemove(player, start, target, promoteto)
+        return self.game.moves[-1]
+
+def batchstatus(positions, withmoves=False):
+    """
+    Status of many positions, each a FEN string (None for the start
+    position) or a (fen, moves) pair. One Position is set up again for
+    every one, so games, players and boards are not built anew. Yields a
+    status dict, with the legal moves if withmoves, or {'error': reason}.
+    """
+
+    position = Position()
+    for item in positions:
+        fen, moves = (item, ()) if item is None or isinstance(item, str) else item
+        try:
+            position.reset(fen, moves)
+        except ValueError as error:
+            yield {'error': str(error)}
+            continue
+        status = position.status()
+        if withmoves:
+            status['moves'] = position.legalmoves()
+        yield status
+
+def randompositions(count, seed=0, maxplies=60):
+    """ FENs of random walks from the start position, for benchmarks """
+
+    generator = random.Random(seed)
+    position = Position()
+    fens = []
+    while len(fens) < count:
+        position.reset()
+        for ply in range(generator.randrange(maxplies)):
+            moves = position.legalmoves()
+            if not moves:
+                break
+            position.apply(generator.choice(moves))
+        fens.append(position.fen())
+    return fens
+
+def runbatchbench(args):
+    """ The batchbench command, batch status queries per second """
+
+    fens = randompositions(args.positions, args.seed)
+    for name, run in [('new Position per query',
+                       lambda: [Position(fen).status() for fen in fens]),
+                      ('batchstatus',
+                       lambda: list(batchstatus(fens, args.moves)))]:
+        begin = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - begin
+        print(f"{name:24s} {len(fens)} positions in {elapsed:.2f}s  "
+              f"{len(fens)/elapsed:10.0f} queries/s")
+
+# Book weight of a move by the game result and the colour playing it
+BOOKSCORES = {('1-0', 'white'): 2, ('1-0', 'black'): 0,
+              ('0-1', 'white'): 0, ('0-1', 'black'): 2}
+
+def buildbook(lines, path, maxplies=20):
+    """
+    Write an OpeningBook of the first maxplies of every game in a PGN stream,
+    returns the number of entries. Moves of the winner count 2, of a draw or
+    unknown result 1, and moves of the loser are left out.
+    """
+
+    weights = collections.Counter()
+    for tags, movetext in readpgn(lines):
+        try:
+            game, player = headlessgame(fen=tags.get('FEN'))
+        except (ValueError, IndexError, KeyError, AttributeError):
+            # A game with a bad FEN tag is left out
+            continue
+        if len(game.board.kings) != 2:
+            continue
+        player.validmoves = list(player.get_validmoves(game.board))
+        result = tags.get('Result')
+        try:
+            # parsesan raises ValueError for illegal and unreadable moves alike
+            for san in itertools.islice(santokens(movetext), maxplies):
+                start, target, promoteto = parsesan(game.board, player, san)
+                weights[game.board.zobrist, encodemove(start, target, promoteto)] \
+                    += BOOKSCORES.get((result, player.colour), 1)
+                player = game.makemove(player, start, target, promoteto)
+        except ValueError:
+            # The moves before an illegal one are still used
+            pass
+
+    # Weights are scaled down if they overflow 16 bits
+    top = max(weights.values(), default=0)
+    entries = 0
+    with open(path, 'wb') as book:
+        for (key, move), weight in sorted(weights.items()):
+            if top > 65535:
+                weight = weight * 65535 // top
+            if weight:
+                book.write(OpeningBook.ENTRY.pack(key, move, weight, 0))
+                entries += 1
+    return entries
+
+def runbook(args):
+    """ The book command """
+
+    with open(args.file, encoding='utf-8', errors='replace') as lines:
+        entries = buildbook(lines, args.output, args.plies)
+    print(f"{entries} entries written to {args.output}", file=sys.stderr)
+
+# Evaluation tuning. A position is encoded as up to 32 int16 codes, one per
+# piece: 1 + its piece number * 64 + its piece-square table index, negative
+# for black and 0 for padding, with its phase and the game result for white.
+TUNENAMES = list(PIECEVALUES)
+TUNESHARD = 1 << 20
+TUNERESULTS = {'1-0': 2, '1/2-1/2': 1, '0-1': 0}
+
+def positioncodes(board):
+    """ The feature codes of every piece on the board, padded to 32 """
+
+    codes = []
+    for (row, col), piece in board.items():
+        number = TUNENAMES.index(piece.piecename)
+        if piece.colour == 'white':
+            codes.append(1 + number*64 + (7-row)*8 + col)
+        else:
+            codes.append(-(1 + number*64 + row*8 + col))
+    return codes + [0] * (32 - len(codes))
+
+def tunegames(paths):
+    """ (result, moves) of the finished games in selfplay JSONL and PGN files """
+
+    for path in paths:
+        with open(path, encoding='utf-8', errors='replace') as lines:
+            if path.lower().endswith('.pgn'):
+                for tags, movetext in readpgn(lines):
+                    if tags.get('Result') in TUNERESULTS:
+                        yield tags['Result'], list(santokens(movetext))
+            else:
+                for line in lines:
+                    record = json.loads(line)
+                    if record.get('result') in TUNERESULTS:
+                        yield record['result'], record['moves']
+
+class FeatureShards():
+    """
+    Writes encoded positions to numbered .npy shards in a directory: codes
+    as an (n, 32) int16 array, phases and results as uint8 arrays, the
+    result in half points for white
+    """
+
+    def __init__(self, directory, shardsize=TUNESHARD):
+        self.directory = directory
+        self.shardsize = shardsize
+        self.shards    = 0
+        self.positions = 0
+        os.makedirs(directory, exist_ok=True)
+        self.clear()
+
+    def clear(self):
+        self.codes, self.phases, self.results = \
+            array.array('h'), array.array('B'), array.array('B')
+
+    def add(self, board, result):
+        self.codes.extend(positioncodes(board))
+        self.phases.append(min(board.phase, MAXPHASE))
+        self.results.append(result)
+        self.positions += 1
+        if len(self.phases) >= self.shardsize:
+            self.flush()
+
+    def flush(self):
+        if not self.phases:
+            return
+        for name, values, dtype in [('codes', self.codes, numpy.int16),
+                                    ('phases', self.phases, numpy.uint8),
+                                    ('results', self.results, numpy.uint8)]:
+            values = numpy.frombuffer(values, dtype=dtype)
+            if name == 'codes':
+                values = values.reshape(-1, 32)
+            numpy.save(os.path.join(self.directory,
+                                    f"{name}-{self.shards:05d}.npy"), values)
+        self.shards += 1
+        self.clear()
+
+def encodegames(paths, directory, skip=8, shardsize=TUNESHARD):
+    """
+    Replay the games of paths into feature shards, returns the number of
+    positions. The first skip plies and positions in check are left out.
+    """
+
+    shards = FeatureShards(directory, shardsize)
+    for result, moves in tunegames(paths):
+        game, player = headlessgame()
+        player.validmoves = list(player.get_validmoves(game.board))
+        try:
+            for ply, move in enumerate(moves):
+                if ply >= skip and not player.isincheck(game.board):
+                    shards.add(game.board, TUNERESULTS[result])
+                if re.match(r'^[a-h][1-8][a-h][1-8][nbrq]?$', move):
+                    start, target = player.getposition(move)
+                    promoteto = FENLETTERS[move[4]] if len(move) > 4 else None
+                    if (start, target) not in player.validmoves:
+                        raise ValueError(f"Illegal move {move}")
+                else:
+                    start, target, promoteto = parsesan(game.board, player, move)
+                player = game.makemove(player, start, target, promoteto)
+        except (ValueError, KeyError):
+            # Positions before an illegal move are still used
+            pass
+    shards.flush()
+    return shards.positions
+
+def loadshards(directory):
+    """ (codes, phases, results) of every shard, memory-mapped """
+
+    shards = []
+    for name in sorted(os.listdir(directory)):
+        if name.startswith('codes-') and name.endswith('.npy'):
+            number = name[len('codes-'):]
+            shards.append(tuple(numpy.load(os.path.join(directory, f"{kind}-{number}"),
+                                           mmap_mode='r')
+                                for kind in ('codes', 'phases', 'results')))
+    return shards
+
+class TexelTuner():
+    """
+    Fits the material values and piece-square tables to game results: the
+    evaluation, scaled by a sigmoid, predicts the result and Adam descends
+    the mean squared error. Loss and gradients are computed for a batch of
+    positions at once.
+    """
+
+    def __init__(self, shards, batch=1 << 16, rate=1.0):
+        self.shards = shards
+        self.batch  = batch
+        self.rate   = rate
+        # Every piece code's middlegame and endgame weight, value plus table
+        self.weights = numpy.zeros((2, len(TUNENAMES), 64))
+        for number, name in enumerate(TUNENAMES):
+            for phase, (values, tables) in enumerate([(MGVALUES, MGTABLES),
+                                                      (EGVALUES, EGTABLES)]):
+                self.weights[phase, number] = values[name] + \
+                                              numpy.array(tables[name])
+        self.moments = numpy.zeros((2,) + self.weights.shape)
+        self.steps = 0
+        self.scale = self.fitscale()
+
+    def batches(self):
+        for codes, phases, results in self.shards:
+            for begin in range(0, len(phases), self.batch):
+                end = begin + self.batch
+                yield (numpy.asarray(codes[begin:end]),
+                       numpy.asarray(phases[begin:end], dtype=numpy.float64) / MAXPHASE,
+                       numpy.asarray(results[begin:end], dtype=numpy.float64) / 2)
+
+    def scores(self, codes, phases):
+        """ Evaluations for white of a batch, with the piece signs and indexes """
+
+        signs = numpy.sign(codes)
+        indexes = numpy.abs(codes.astype(numpy.int32)) - 1
+        indexes[indexes < 0] = 0
+        weights = self.weights.reshape(2, -1)
+        mg = (signs * weights[0][indexes]).sum(axis=1)
+        eg = (signs * weights[1][indexes]).sum(axis=1)
+        return mg * phases + eg * (1 - phases), signs, indexes
+
+    def loss(self, scale=None):
+        scale = scale or self.scale
+        total, count = 0.0, 0
+        for codes, phases, results in self.batches():
+            scores = self.scores(codes, phases)[0]
+            total += ((results - 1 / (1 + numpy.exp(-scale * scores)))**2).sum()
+            count += len(results)
+        return total / max(count, 1)
+
+    def fitscale(self):
+        """ The sigmoid scale that fits the untuned evaluation best """
+
+        best = None
+        for step in range(-8, 9):
+            scale = math.log(10) / 400 * 2**(step / 4)
+            loss = self.loss(scale)
+            if best is None or loss < best[0]:
+                best = (loss, scale)
+        return best[1]
+
+    def epoch(self):
+        """ One pass of Adam steps over all batches, returns the loss before """
+
+        total, count = 0.0, 0
+        for codes, phases, results in self.batches():
+            scores, signs, indexes = self.scores(codes, phases)
+            predictions = 1 / (1 + numpy.exp(-self.scale * scores))
+            errors = results - predictions
+            total += (errors**2).sum()
+            count += len(results)
+
+            # d loss / d score of every position, then spread over its pieces
+            slopes = -2 * errors * predictions * (1 - predictions) * \
+                     self.scale / len(results)
+            gradient = numpy.empty_like(self.weights)
+            for phase, share in enumerate([phases, 1 - phases]):
+                pieces = (slopes * share)[:, None] * signs
+                gradient[phase] = numpy.bincount(
+                    indexes.ravel(), weights=pieces.ravel(),
+                    minlength=len(TUNENAMES)*64).reshape(len(TUNENAMES), 64)
+            self.step(gradient)
+        return total / max(count, 1)
+
+    def step(self, gradient):
+        self.steps += 1
+        first, second = self.moments
+        first *= 0.9
+        first += 0.1 * gradient
+        second *= 0.999
+        second += 0.001 * gradient**2
+        corrected = first / (1 - 0.9**self.steps)
+        self.weights -= self.rate * corrected / \
+                        (numpy.sqrt(second / (1 - 0.999**self.steps)) + 1e-12)
+
+    def tables(self):
+        """
+        The weights split back into values and tables: a piece's value is
+        its mean weight over the squares positions put it on
+        """
+
+        weights = numpy.rint(self.weights).astype(int)
+        used = numpy.zeros((len(TUNENAMES), 64), dtype=bool)
+        for codes, phases, results in self.shards:
+            indexes = numpy.abs(numpy.asarray(codes, dtype=numpy.int32)) - 1
+            used.ravel()[indexes[indexes >= 0]] = True
+        tuned = {'mgvalues': {}, 'egvalues': {}, 'mgtables': {}, 'egtables': {}}
+        for phase, kind in enumerate(['mg', 'eg']):
+            for number, name in enumerate(TUNENAMES):
+                row = weights[phase, number]
+                value = PIECEVALUES[name] if name == 'k' or not used[number].any() \
+                        else int(round(row[used[number]].mean()))
+                tuned[f'{kind}values'][name] = value
+                tuned[f'{kind}tables'][name] = [int(weight - value) for weight in row]
+        return tuned
+
+def runtunedata(args):
+    """ The tunedata command """
+
+    if numpy is None:
+        print("The tunedata command needs NumPy", file=sys.stderr)
+        return 1
+    positions = encodegames(args.files, args.output, args.skip, args.shard)
+    print(f"{positions} positions written to {args.output}", file=sys.stderr)
+    return 0
+
+def runtune(args):
+    """ The tune command, writes the tuned values and tables as JSON """
+
+    if numpy is None:
+        print("The tune command needs NumPy", file=sys.stderr)
+        return 1
+    shards = loadshards(args.directory)
+    if not shards:
+        print(f"No shards in {args.directory}", file=sys.stderr)
+        return 1
+    tuner = TexelTuner(shards, args.batch, args.rate)
+    print(f"{sum(len(shard[1]) for shard in shards)} positions, "
+          f"sigmoid scale {tuner.scale:.5f}", file=sys.stderr)
+    for epoch in range(args.epochs):
+        begin = time.perf_counter()
+        loss = tuner.epoch()
+        print(f"epoch {epoch+1:3d}  loss {loss:.6f}  "
+              f"{time.perf_counter() - begin:.2f}s", file=sys.stderr)
+    print(f"final loss {tuner.loss():.6f}", file=sys.stderr)
+
+    saveeval(args.output, tuner.tables())
+    print(f"Tables written to {args.output}", file=sys.stderr)
+    return 0
+
+def runbench(args):
+    """ The bench command, fixed depth searches for every process count """
+
+    names = ['startpos', 'kiwipete', 'middlegame']
+    for processes in args.processes:
+        parallel = ParallelSearch(processes, args.hash) if processes > 1 else None
+        nodes, elapsed = 0, 0.0
+        for name in names:
+            game, player = headlessgame(fen=PERFTPOSITIONS[name][0])
+            begin = time.perf_counter()
+            if parallel:
+                parallel.table.clear()
+                parallel.run(game.board, player, maxdepth=args.depth)
+                nodes += parallel.nodes
+            else:
+                search = Search(game.board, player, maxdepth=args.depth,
+                                table=TranspositionTable(args.hash))
+                search.run()
+                nodes += search.nodes
+            elapsed += time.perf_counter() - begin
+        print(f"{processes:3d} processes  depth {args.depth}  {elapsed:8.2f}s "
+              f"to depth  {nodes:10d} nodes  {nodes/elapsed:10.0f} nodes/s")
+        del parallel
+
+# Puzzles of the mate command: FEN, moves the solver gets and if it mates
+MATEPUZZLES = [
+    ('6k1/5ppp/8/8/8/8/8/R5K1 w - - 0 1', 1, True),
+    ('rnbqkbnr/pppp1ppp/8/4p3/6P1/5P2/PPPPP2P/RNBQKBNR b KQkq - 0 2', 1, True),
+    ('r1bqkb1r/pppp1ppp/2n2n2/4p2Q/2B1P3/8/PPPP1PPP/RNB1K1NR w KQkq - 4 4', 1, True),
+    ('k7/2P5/1K6/8/8/8/8/8 w - - 0 1', 1, True),
+    ('r6k/6pp/7N/8/8/1Q6/8/6K1 w - - 0 1', 2, True),
+    ('4kb1r/p2n1ppp/4q3/4p1B1/4P3/1Q6/PPP2PPP/2KR4 w k - 1 16', 2, True),
+    ('r1b2k1r/ppp1bppp/8/1B1Q4/5q2/2P5/PPP2PPP/R3R1K1 w - - 0 1', 2, True),
+    ('r2qk2r/pb4pp/1n2Pb2/2B2Q2/p1p5/2P5/2B2PPP/RN2R1K1 w - - 1 1', 2, True),
+    ('7k/8/5K2/8/8/8/8/6R1 w - - 0 1', 2, True),
+    ('8/5KPk/8/8/8/8/8/8 w - - 0 1', 2, True),
+    ('8/8/8/8/8/2k5/8/K5Q1 w - - 0 1', 6, True),
+    ('5rk1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1', 2, False),
+    ('4kb1r/p2r1ppp/4qn2/1B2p1B1/4P3/1Q6/PPP2PPP/2KR4 w k - 1 17', 2, False),
+    ('8/8/8/8/8/5k2/8/4K2R w K - 0 1', 3, False),
+]
+
+def runmate(args):
+    """ The mate command, solves a FEN or the puzzles, returns the exit status """
+
+    maxnodes = args.memory * 2**20 // PNNODEBYTES
+    if args.fen:
+        puzzles = [(args.fen, args.moves, None)]
+    else:
+        puzzles = [(fen, args.moves or moves, mates)
+                   for fen, moves, mates in MATEPUZZLES]
+
+    failures = nodes = 0
+    elapsed = 0.0
+    for fen, moves, mates in puzzles:
+        game, player = headlessgame(fen=fen)
+        # With the side not to move in check the position can not occur
+        if player.opponent.isincheck(game.board):
+            failures += 1
+            print(f"{fen:72s} illegal position, {player.opponent.colour} is in check")
+            continue
+        solver = MateSolver(game.board, player, maxnodes)
+        begin = time.perf_counter()
+        line = solver.solve(moves or 3)
+        seconds = time.perf_counter() - begin
+        elapsed += seconds
+        nodes += solver.created
+        if line is None:
+            found = "node cap reached"
+        elif line:
+            found = f"mate in {(len(line)+1) // 2}: {' '.join(line)}"
+        else:
+            found = f"no mate in {moves or 3}"
+        if mates is not None and (line is None or bool(line) != mates):
+            failures += 1
+            found += "  FAILED"
+        print(f"{fen:72s} {solver.created:8d} nodes {seconds:7.2f}s  {found}")
+    if len(puzzles) > 1:
+        print(f"{len(puzzles)} puzzles, {failures} failed, {nodes} nodes "
+              f"in {elapsed:.2f}s, {nodes/elapsed:.0f} nodes/s")
+    return 1 if failures else 0
+
+def runreplay(args):
+    """ The replay command, returns the exit status """
+
+    try:
+        log = GameLog(args.file)
+    except FileNotFoundError as error:
+        print(f"No such log {error.filename}", file=sys.stderr)
+        return 1
+    try:
+        if args.game is None:
+            for number in range(log.games()):
+                offset, fenlength, plies, result = log.entry(number)
+                print(f"{number:6d}  {plies:4d} plies  {log.RESULTS[result]:7s}  "
+                      f"{log.fen(number) or 'start position'}")
+            return 0
+        if not 0 <= args.game < log.games():
+            print(f"No game {args.game} in {args.file}", file=sys.stderr)
+            return 1
+        begin = time.perf_counter()
+        game, player = log.replay(args.game, args.ply)
+        elapsed = time.perf_counter() - begin
+    finally:
+        log.close()
+    game.printboard()
+    print(game.getfen(player))
+    print(f"{len(game.moves)} plies replayed in {elapsed*1000:.1f} ms: "
+          f"{' '.join(game.moves)}", file=sys.stderr)
+    return 0
+
+def runtablebase(args):
+    """ The tablebase command """
+
+    for material in args.material:
+        begin = time.perf_counter()
+        built = buildtablebase(material)
+        print(f"{', '.join(built)} written to {TBDIR} "
+              f"in {time.perf_counter() - begin:.1f}s", file=sys.stderr)
+
+def analysegame(job):
+    """ Replay one PGN game, returns the status of every position in it """
+
+    index, tags, movetext, evaldepth = job
+    try:
+        game, player = headlessgame(fen=tags.get('FEN'))
+        if len(game.board.kings) != 2:
+            raise ValueError("a king is missing")
+    except (ValueError, IndexError, KeyError, AttributeError) as error:
+        return [{'game': index, 'ply': 0, 'error': f"Bad FEN tag: {error}"}]
+    player.validmoves = list(player.get_validmoves(game.board))
+
+    results = []
+    try:
+        for ply, san in enumerate(santokens(movetext)):
+            status = positionstatus(game, player, evaldepth)
+            status.update(game=index, ply=ply, move=san)
+            results.append(status)
+            start, target, promoteto = parsesan(game.board, player, san)
+            player = game.makemove(player, start, target, promoteto)
+        status = positionstatus(game, player, evaldepth)
+        status.update(game=index, ply=len(game.moves), move=None)
+        results.append(status)
+    except (ValueError, KeyError) as error:
+        results.append({'game': index, 'ply': len(game.moves), 'error': str(error)})
+    return results
+
+def analyseepd(job):
+    """ Status of a batch of EPD positions """
+
+    results = []
+    for index, fen, operations in job[0]:
+        game, player = headlessgame(fen=fen)
+        player.validmoves = list(player.get_validmoves(game.board))
+        status = positionstatus(game, player, job[1])
+        status.update(position=index, **{op: operations[op] for op in operations
+                                         if op in ('id', 'bm', 'am')})
+        results.append(status)
+    return results
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def boundedimap(pool, function, jobs, window):
+    """ Ordered pool.imap that reads at most window jobs ahead of the results """
+
+    pending = collections.deque()
+    for job in jobs:
+        pending.append(pool.apply_async(function, (job,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def analyse(lines, fileformat='pgn', evaldepth=None, workers=1):
+    """
+    Stream the status of every position in a PGN or EPD collection.
+    Only a few games per worker are in memory at any time.
+    """
+
+    if fileformat == 'pgn':
+        jobs = ((index, tags, movetext, evaldepth)
+                for index, (tags, movetext) in enumerate(readpgn(lines)))
+        function = analysegame
+    else:
+        jobs = ((chunk, evaldepth) for chunk in
+                chunks(((index, fen, operations) for index, (fen, operations)
+                        in enumerate(readepd(lines))), 64))
+        function = analyseepd
+
+    if workers == 1:
+        for results in map(function, jobs):
+            yield from results
+        return
+
+    with multiprocessing.Pool(workers) as pool:
+        for results in boundedimap(pool, function, jobs, workers*4):
+            yield from results
+
+def runanalyse(args):
+    """ The analyse command, one JSON line per position """
+
+    fileformat = args.format or \
+                 ('epd' if args.file.lower().endswith('.epd') else 'pgn')
+    output = open(args.output, 'w') if args.output else sys.stdout
+    with open(args.file, encoding='utf-8', errors='replace') as lines:
+        for status in analyse(lines, fileformat, args.depth, args.workers):
+            output.write(json.dumps(status) + "\n")
+    if output is not sys.stdout:
+        output.close()
+
+# go parameters taking a number
+GOPARAMETERS = ('wtime', 'btime', 'winc', 'binc', 'movestogo', 'depth',
+                'nodes', 'mate', 'movetime')
+
+class UCIEngine():
+    """
+    The engine side of the UCI protocol. Commands are read by an asyncio
+    loop while the search runs in a worker thread, so stop and isready are
+    answered at once even mid-search. Positions are played into a headless
+    Game, nothing is drawn on the terminal.
+    """
+
+    def __init__(self, output=None):
+        self.output  = output or sys.stdout
+        self.lock    = threading.Lock()
+        self.worker  = concurrent.futures.ThreadPoolExecutor(1)
+        self.hashmb  = 16
+        self.table   = None
+        self.threads = 1
+        self.parallel = None
+        self.search  = None
+        self.task    = None
+        self.game, self.player = headlessgame()
+        self.player.validmoves = list(self.player.get_validmoves(self.game.board))
+
+    def send(self, line):
+        # The worker thread reports too, lines must not interleave
+        with self.lock:
+            self.output.write(line + "\n")
+            self.output.flush()
+
+    async def lines(self):
+        """ Lines of standard input, read without blocking the loop """
+
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        try:
+            await loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        except (ValueError, OSError, NotImplementedError):
+            # Regular files and Windows consoles are read in a thread
+            while True:
+                line = await loop.run_in_executor(None, sys.stdin.readline)
+                if not line:
+                    return
+                yield line
+        else:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                yield line.decode()
+
+    async def run(self):
+        async for line in self.lines():
+            words = line.split()
+            if not words:
+                continue
+            command, args = words[0], words[1:]
+            if command == 'quit':
+                break
+            handler = getattr(self, f"uci{command}", None)
+            if handler:
+                result = handler(args)
+                if asyncio.iscoroutine(result):
+                    await result
+        await self.ucistop([])
+        self.worker.shutdown()
+
+    def uciuci(self, args):
+        self.send("id name Chessmastah 0.7")
+        self.send("id author Svein Arne Roed")
+        self.send("option name Hash type spin default 16 min 1 max 4096")
+        self.send("option name Threads type spin default 1 min 1 max 256")
+        self.send("option name Ponder type check default false")
+        self.send("uciok")
+
+    def uciisready(self, args):
+        self.send("readyok")
+
+    def ucisetoption(self, args):
+        line = ' '.join(args)
+        match = re.match(r'name\s+(.*?)(?:\s+value\s+(.*))?$', line)
+        if not match or not match.group(2):
+            return
+        name, value = match.group(1).lower(), match.group(2).strip()
+        if name not in ('hash', 'threads'):
+            return
+        if not re.match(r'^-?\d+$', value):
+            self.send(f"info string bad value {value} for {match.group(1)}")
+            return
+        if name == 'hash':
+            self.hashmb = max(1, int(value))
+        else:
+            self.threads = max(1, int(value))
+        self.table = self.parallel = None
+
+    async def uciucinewgame(self, args):
+        await self.ucistop([])
+        if self.table:
+            self.table.clear()
+
+    async def uciposition(self, args):
+        """ position startpos|fen FEN [moves MOVE ...] """
+
+        await self.ucistop([])
+        moves = args.index('moves') if 'moves' in args else len(args)
+        fen = ' '.join(args[1:moves]) if args and args[0] == 'fen' else None
+        try:
+            game, player = headlessgame(fen=fen)
+        except (ValueError, IndexError, KeyError, AttributeError):
+            self.send(f"info string bad fen {fen}")
+            return
+        # Moves can only be generated with both kings on the board
+        if len(game.board.kings) != 2:
+            self.send(f"info string bad fen {fen}, a king is missing")
+            return
+        player.validmoves = list(player.get_validmoves(game.board))
+
+        for move in args[moves+1:]:
+            move = move.lower()
+            if not MOVEPATTERN.match(move):
+                self.send(f"info string illegal move {move}")
+                break
+            start, target, promoteto = movefromstring(move)
+            if (start, target) not in player.validmoves:
+                self.send(f"info string illegal move {move}")
+                break
+            if not player.ispromotion(game.board, start, target):
+                promoteto = None
+            player = game.makemove(player, start, target, promoteto)
+        self.game, self.player = game, player
+
+    def budget(self, params):
+        """ Seconds to think from the go parameters, None for no limit """
+
+        if 'movetime' in params:
+            return params['movetime'] / 1000
+        side = 'w' if self.player.colour == 'white' else 'b'
+        if f'{side}time' not in params:
+            return None
+        left = params[f'{side}time'] / 1000
+        increment = params.get(f'{side}inc', 0) / 1000
+        share = left / params.get('movestogo', 30) + increment * 0.75
+        return max(0.01, min(share, left * 0.5 - 0.05))
+
+    async def ucigo(self, args):
+        await self.ucistop([])
+        params, flags, rootmoves = {}, set(), []
+        words = iter(args)
+        word = next(words, None)
+        while word is not None:
+            following = next(words, None)
+            if word in ('infinite', 'ponder'):
+                flags.add(word)
+            elif word == 'searchmoves':
+                while following is not None and MOVEPATTERN.match(following):
+                    rootmoves.append(following)
+                    following = next(words, None)
+            elif word in GOPARAMETERS and following is not None:
+                # Unknown words and values that are no numbers are left out
+                if re.match(r'^-?\d+$', following):
+                    params[word] = int(following)
+                following = next(words, None)
+            word = following
+        # Moves that are not legal here are left out
+        rootmoves = [move for move in rootmoves
+                     if movefromstring(move)[:2] in self.player.validmoves]
+
+        if self.table is None:
+            if self.threads > 1:
+                self.parallel = ParallelSearch(self.threads, self.hashmb)
+                self.table = self.parallel.table
+            else:
+                self.table = TranspositionTable(self.hashmb)
+        movetime = self.budget(params)
+        search = Search(self.game.board, self.player,
+                        None if flags else movetime,
+                        params.get('nodes'), params.get('depth'), self.table)
+        search.fresh = self.parallel is None
+        search.rootmoves = set(rootmoves) or None
+        # Kept for ponderhit, which turns pondering into a timed search
+        search.budget = movetime
+        # An infinite or ponder search holds its bestmove until released
+        search.released = asyncio.Event()
+        if not flags:
+            search.released.set()
+        self.search = search
+        self.task = asyncio.ensure_future(self.report(search))
+
+    def uciponderhit(self, args):
+        search = self.search
+        if search and not search.released.is_set():
+            if search.budget:
+                search.movetime = search.budget
+                search.deadline = time.perf_counter() + search.budget
+            search.released.set()
+
+    async def ucistop(self, args):
+        if self.task:
+            self.search.stop()
+            self.search.released.set()
+            await self.task
+            self.task = None
+
+    def think(self, search):
+        """ The worker thread's search, reporting every finished depth """
+
+        begin = time.perf_counter()
+        if self.parallel:
+            self.parallel.start(search.board, search.player, search.maxdepth)
+        for depth, score, move in search.iterate():
+            if move is None:
+                break
+            elapsed = time.perf_counter() - begin
+            if abs(score) >= MATE - 1000:
+                plies = MATE - abs(score)
+                score = f"mate {(plies + 1) // 2 * (1 if score > 0 else -1)}"
+            else:
+                score = f"cp {score}"
+            self.send(f"info depth {depth} score {score} nodes {search.nodes} "
+                      f"time {int(elapsed*1000)} "
+                      f"nps {int(search.nodes / max(elapsed, 1e-3))} "
+                      f"pv {movestring(*move)}")
+        if self.parallel:
+            best = self.parallel.finish(search)[2]
+            # The helpers search every root move
+            if not search.rootmoves:
+                return best
+        return search.bestmove
+
+    async def report(self, search):
+        loop = asyncio.get_running_loop()
+        move = await loop.run_in_executor(self.worker, self.think, search)
+        await search.released.wait()
+        if move is None:
+            self.send("bestmove 0000")
+            return
+        line = f"bestmove {movestring(*move)}"
+        ponder = self.pondermove(move)
+        if ponder:
+            line += f" ponder {movestring(*ponder)}"
+        self.send(line)
+
+    def pondermove(self, move):
+        """ The reply the transposition table expects to move, if any """
+
+        board, player = self.game.board, self.player
+        if not self.table:
+            return None
+        player.playmove(board, *move)
+        entry = self.table.probe(board.zobrist)
+        reply = decodemove(entry[3]) if entry and entry[3] else None
+        if reply and reply[:2] not in player.opponent.get_validmoves(board):
+            reply = None
+        player.takeback(board, *move)
+        return reply
+
+def runuci(args):
+    """ The uci command """
+
+    asyncio.run(UCIEngine().run())
+
+# Where the game server listens unless told otherwise
+SERVERHOST = '127.0.0.1'
+SERVERPORT = 7070
+
+def servermove(job):
+    """ A server game's AI move, worked out in an executor process """
+
+    snapshot, colour, playedturns, seed, budget = job
+    board = pickle.loads(snapshot)
+    game, player = headlessgame(seed=seed, **budget)
+    for other in game.players.values():
+        other.playedturns = playedturns[other.colour]
+    player = game.players[colour]
+    player.validmoves = list(player.get_validmoves(board))
+    return player.getmove(board)
+
+
+class ServerSession():
+    """
+    The game of one server connection. Every session has its own Game and
+    players, so nothing but the executor is shared with other games.
+    Commands answer with one line, 'ok ...' or 'error ...'.
+    """
+
+    def __init__(self, server, number):
+        self.server = server
+        self.number = number
+        self.game   = None
+        self.player = None
+        # The colour the client plays, None when the AI plays both sides
+        self.human  = None
+
+    async def command(self, line):
+        words = line.split()
+        if not words:
+            return None
+        command = words[0].lower()
+        handler = getattr(self, f"cmd{command}", None)
+        if handler is None:
+            return f"error unknown command {command}"
+        if command != 'new' and self.game is None:
+            return "error no game, start one with new"
+        return await handler(words[1:])
+
+    def state(self):
+        result = self.game.status(self.player)
+        return {None: 'playing', 1: 'draw', 2: 'checkmate'}[result]
+
+    async def cmdnew(self, args):
+        """ new [white|black|none] [fen FEN] """
+
+        human = args[0].lower() if args else 'white'
+        if human not in ('white', 'black', 'none'):
+            return f"error no such side {human}"
+        fen = ' '.join(args[2:]) if len(args) > 2 and args[1] == 'fen' else None
+        try:
+            self.game, self.player = headlessgame(fen=fen)
+        except (ValueError, IndexError, KeyError, AttributeError):
+            self.game = None
+            return "error bad fen"
+        # Moves can only be generated with both kings on the board
+        if len(self.game.board.kings) != 2:
+            self.game = None
+            return "error bad fen"
+        self.human = None if human == 'none' else human
+        self.player.validmoves = list(self.player.get_validmoves(self.game.board))
+        if self.human and self.player.colour != self.human:
+            return await self.aireply()
+        return f"ok - {self.state()}"
+
+    async def cmdmove(self, args):
+        """ move MOVE, the AI answers if the client plays one side """
+
+        move = args[0].lower() if args else ''
+        if not MOVEPATTERN.match(move):
+            return f"error bad move {move}"
+        state = self.state()
+        if state != 'playing':
+            return f"error game over {state}"
+        if self.human and self.player.colour != self.human:
+            return "error not your move"
+        start, target = self.player.getposition(move)
+        if (start, target) not in self.player.validmoves:
+            return f"error illegal move {move}"
+        # A promotion without a piece letter becomes a queen
+        promoteto = None
+        if self.player.ispromotion(self.game.board, start, target):
+            promoteto = FENLETTERS[move[4]] if len(move) > 4 else 'q'
+        self.player = self.game.makemove(self.player, start, target, promoteto)
+        if self.human and self.state() == 'playing':
+            return await self.aireply()
+        return f"ok - {self.state()}"
+
+    async def cmdgo(self, args):
+        """ go, the AI plays the side to move """
+
+        state = self.state()
+        if state != 'playing':
+            return f"error game over {state}"
+        return await self.aireply()
+
+    async def aireply(self):
+        player, game = self.player, self.game
+        playedturns = {player.colour: player.playedturns,
+                       player.opponent.colour: player.opponent.playedturns}
+        job = (pickle.dumps(game.board), player.colour, playedturns,
+               f"{self.server.seed}-{self.number}-{len(game.moves)}",
+               self.server.budget)
+        loop = asyncio.get_running_loop()
+        start, target = await loop.run_in_executor(self.server.executor,
+                                                   servermove, job)
+        self.player = game.makemove(player, start, target)
+        return f"ok {game.moves[-1]} {self.state()}"
+
+    async def cmdfen(self, args):
+        return f"ok {self.game.getfen(self.player)}"
+
+    async def cmdmoves(self, args):
+        moves = sorted(movestring(start, target)
+                       for start, target in self.player.validmoves)
+        return f"ok {' '.join(moves)}".rstrip()
+
+
+class GameServer():
+    """
+    Hosts any number of concurrent games over TCP or a Unix socket, one
+    ServerSession per connection, with a line protocol:
+
+        new [white|black|none] [fen FEN]   start a game, playing the side
+                                           given or letting the AI play both
+        move MOVE                          play MOVE, e.g. e2e4 or e7e8q
+        go                                 let the AI play the side to move
+        fen, moves                         the position, the legal moves
+        quit                               close the connection
+
+    new, move and go answer 'ok MOVE STATE' with the AI's move, or '-', and
+    playing, draw or checkmate. AI moves are searched in a process pool, so
+    a slow search holds up its own game only.
+    """
+
+    def __init__(self, budget, workers=None, seed=0):
+        self.budget   = budget
+        self.seed     = seed
+        # Spawned, so the workers hold no copy of the listening socket
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn'))
+        self.sessions = {}
+        self.count    = 0
+
+    async def handle(self, reader, writer):
+        self.count += 1
+        session = self.sessions[self.count] = ServerSession(self, self.count)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line or line.split()[:1] == [b'quit']:
+                    break
+                reply = await session.command(line.decode(errors='replace'))
+                if reply is not None:
+                    writer.write(reply.encode() + b"\n")
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            del self.sessions[session.number]
+            writer.close()
+
+    async def serve(self, host=SERVERHOST, port=SERVERPORT, path=None):
+        if path:
+            server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        address = path or ':'.join(map(str, server.sockets[0].getsockname()[:2]))
+        print(f"Serving games on {address}", file=sys.stderr)
+        try:
+            # Shut the executor down on a plain kill too
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, asyncio.current_task().cancel)
+        except (NotImplementedError, RuntimeError):
+            pass
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+
+def runserve(args):
+    """ The serve command """
+
+    budget = {'movetime': args.movetime, 'maxnodes': args.nodes,
+              'maxdepth': args.depth, 'hashmb': args.hash}
+    server = GameServer(budget, args.workers, args.seed)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+async def loadclient(args, latencies):
+    """ One load test connection playing AI games, returns the moves made """
+
+    if args.unix:
+        reader, writer = await asyncio.open_unix_connection(args.unix)
+    else:
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+
+    async def request(line):
+        writer.write(line.encode() + b"\n")
+        await writer.drain()
+        return (await reader.readline()).decode().split()
+
+    moves = 0
+    for game in range(args.games):
+        await request("new none")
+        for ply in range(args.maxplies):
+            begin = time.perf_counter()
+            reply = await request("go")
+            latencies.append(time.perf_counter() - begin)
+            if reply[:1] != ['ok']:
+                raise ConnectionError(' '.join(reply) or "connection closed")
+            moves += 1
+            if reply[2] != 'playing':
+                break
+    writer.write(b"quit\n")
+    writer.close()
+    return moves
+
+async def loadtest(args):
+    latencies = []
+    begin = time.perf_counter()
+    moves = await asyncio.gather(*[loadclient(args, latencies)
+                                   for client in range(args.clients)])
+    elapsed = time.perf_counter() - begin
+    latencies.sort()
+    percentile = lambda share: latencies[int(share * (len(latencies)-1))] * 1000
+    print(f"{args.clients} clients, {sum(moves)} moves in {elapsed:.2f}s "
+          f"({sum(moves) / elapsed:.1f} moves/s), latency "
+          f"p50 {percentile(0.5):.1f} ms p99 {percentile(0.99):.1f} ms")
+
+def runloadtest(args):
+    """ The loadtest command, returns the exit status """
+
+    try:
+        asyncio.run(loadtest(args))
+    except (ConnectionError, OSError) as error:
+        print(f"Load test failed: {error}", file=sys.stderr)
+        return 1
+    return 0
+
+def commandline(argv=None):
+    """ Headless commands, plain 'ChessMastah_0_7.py' starts a game """
+
+    parser = argparse.ArgumentParser(description="Chessmastah, console chess")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="run under cProfile and write pstats output to "
+                             "FILE (pool workers are not profiled)")
+    parser.add_argument('--record', metavar='FILE',
+                        help="record interactive games into the game log FILE")
+    commands = parser.add_subparsers(dest='command')
+
+    perftparser = commands.add_parser('perft', help="count move tree nodes")
+    perftparser.add_argument('-d', '--depth', type=int)
+    perftparser.add_argument('--fen', help="position to count from")
+    perftparser.add_argument('--position', choices=sorted(PERFTPOSITIONS),
+                             help="one of the reference positions")
+    perftparser.add_argument('--divide', action='store_true',
+                             help="list the node count of every root move")
+    perftparser.add_argument('--verify', action='store_true',
+                             help="check the incrementally kept board state "
+                                  "against a recount at every node")
+    perftparser.add_argument('--backend', choices=sorted(BOARDS),
+                             default='dict')
+
+    selfplayparser = commands.add_parser('selfplay',
+                                         help="play silent AI games in batch")
+    selfplayparser.add_argument('-n', '--games', type=int, default=10)
+    selfplayparser.add_argument('-w', '--workers', type=int,
+                                default=os.cpu_count() or 1)
+    selfplayparser.add_argument('--seed', type=int, default=0,
+                                help="game i is played with seed+i")
+    selfplayparser.add_argument('--maxplies', type=int, default=None)
+    selfplayparser.add_argument('-o', '--output',
+                                help="JSONL file, default standard output")
+    selfplayparser.add_argument('--backend', choices=sorted(BOARDS),
+                                default='dict')
+    selfplayparser.add_argument('--movetime', type=float,
+                                help="seconds of search per move")
+    selfplayparser.add_argument('--nodes', type=int,
+                                help="search nodes per move")
+    selfplayparser.add_argument('--depth', type=int,
+                                help="search depth per move, "
+                                     "without any budget the AI plays random captures")
+    selfplayparser.add_argument('--book', help="opening book file to play from")
+    selfplayparser.add_argument('--record', metavar='FILE',
+                                help="also record the games into a game log")
+    selfplayparser.add_argument('--stats', action='store_true',
+                                help="add per turn phase timings and hot path "
+                                     "call counts to every record")
+
+    analyseparser = commands.add_parser('analyse',
+                                        help="status of every position in a "
+                                             "PGN or EPD file")
+    analyseparser.add_argument('file')
+    analyseparser.add_argument('--format', choices=['pgn', 'epd'],
+                               help="default from the file extension")
+    analyseparser.add_argument('--depth', type=int,
+                               help="add a search score of this depth")
+    analyseparser.add_argument('-w', '--workers', type=int, default=1)
+    analyseparser.add_argument('-o', '--output',
+                               help="JSONL file, default standard output")
+
+    bookparser = commands.add_parser('book',
+                                     help="build an opening book from a PGN file")
+    bookparser.add_argument('file')
+    bookparser.add_argument('-o', '--output', default=BOOKFILE)
+    bookparser.add_argument('--plies', type=int, default=20,
+                            help="plies of every game taken into the book")
+
+    tbparser = commands.add_parser('tablebase',
+                                   help="build endgame tablebases")
+    tbparser.add_argument('material', nargs='*', default=TBSETS,
+                          help="material sets like KRvK or KQvKR, default "
+                               "the 3-man sets")
+
+    commands.add_parser('uci', help="run as a UCI engine for chess GUIs")
+
+    benchparser = commands.add_parser('bench',
+                                      help="time to depth and nodes/s of the "
+                                           "parallel search by process count")
+    benchparser.add_argument('-p', '--processes', type=int, nargs='+',
+                             default=[1, 2, 4])
+    benchparser.add_argument('-d', '--depth', type=int, default=4)
+    benchparser.add_argument('--hash', type=int, default=16,
+                             help="transposition table megabytes")
+
+    batchparser = commands.add_parser('batchbench',
+                                      help="status queries/s of the batch API")
+    batchparser.add_argument('-n', '--positions', type=int, default=2000)
+    batchparser.add_argument('--seed', type=int, default=0)
+    batchparser.add_argument('--moves', action='store_true',
+                             help="list the legal moves of every position too")
+
+    mateparser = commands.add_parser('mate',
+                                     help="solve a forced mate by proof-number "
+                                          "search, by default the puzzle set")
+    mateparser.add_argument('fen', nargs='?',
+                            help="position to solve, default the bundled puzzles")
+    mateparser.add_argument('-n', '--moves', type=int,
+                            help="moves to mate in, default 3 or the puzzle's")
+    mateparser.add_argument('--memory', type=int, default=64,
+                            help="megabytes of proof-number nodes")
+
+    replayparser = commands.add_parser('replay',
+                                       help="show a position of a recorded game")
+    replayparser.add_argument('file', help="game log")
+    replayparser.add_argument('game', type=int, nargs='?',
+                              help="game number, without it the games are listed")
+    replayparser.add_argument('ply', type=int, nargs='?',
+                              help="plies played, default the whole game")
+
+    tunedataparser = commands.add_parser('tunedata',
+                                         help="encode the positions of games "
+                                              "into NumPy shards for tune")
+    tunedataparser.add_argument('files', nargs='+',
+                                help="selfplay JSONL or PGN files")
+    tunedataparser.add_argument('-o', '--output', default='tunedata',
+                                help="shard directory")
+    tunedataparser.add_argument('--skip', type=int, default=8,
+                                help="opening plies of every game left out")
+    tunedataparser.add_argument('--shard', type=int, default=TUNESHARD,
+                                help="positions per shard")
+
+    tuneparser = commands.add_parser('tune',
+                                     help="fit the evaluation to game results "
+                                          "(needs NumPy)")
+    tuneparser.add_argument('directory', nargs='?', default='tunedata')
+    tuneparser.add_argument('-o', '--output', default=EVALFILE)
+    tuneparser.add_argument('--epochs', type=int, default=20)
+    tuneparser.add_argument('--batch', type=int, default=1 << 16,
+                            help="positions per gradient step")
+    tuneparser.add_argument('--rate', type=float, default=1.0,
+                            help="Adam step size in centipawns")
+
+    serveparser = commands.add_parser('serve',
+                                      help="host concurrent games over a "
+                                           "line protocol")
+    loadparser = commands.add_parser('loadtest',
+                                     help="play AI games against a running "
+                                          "server, report moves/s and latency")
+    for subparser in (serveparser, loadparser):
+        subparser.add_argument('--host', default=SERVERHOST)
+        subparser.add_argument('--port', type=int, default=SERVERPORT)
+        subparser.add_argument('--unix', metavar='PATH',
+                               help="use a Unix socket instead of TCP")
+    serveparser.add_argument('-w', '--workers', type=int,
+                             default=os.cpu_count() or 1,
+                             help="processes searching AI moves")
+    serveparser.add_argument('--seed', type=int, default=0)
+    serveparser.add_argument('--movetime', type=float,
+                             help="seconds of search per move")
+    serveparser.add_argument('--nodes', type=int,
+                             help="search nodes per move")
+    serveparser.add_argument('--depth', type=int,
+                             help="search depth per move, "
+                                  "without any budget the AI plays random captures")
+    serveparser.add_argument('--hash', type=int, default=4,
+                             help="transposition table megabytes per search")
+    loadparser.add_argument('-c', '--clients', type=int, default=8,
+                            help="concurrent connections")
+    loadparser.add_argument('-n', '--games', type=int, default=2,
+                            help="games played by every client")
+    loadparser.add_argument('--maxplies', type=int, default=100)
+
+    args = parser.parse_args(argv)
+
+    if not args.profile:
+        sys.exit(runcommand(args))
+
+    profiler = cProfile.Profile()
+    try:
+        status = profiler.runcall(runcommand, args)
+    finally:
+        profiler.dump_stats(args.profile)
+        stats = pstats.Stats(args.profile, stream=sys.stderr)
+        stats.sort_stats('cumulative').print_stats(20)
+    sys.exit(status)
+
+def runcommand(args):
+    """ Run the parsed command, returns the exit status """
+
+    if args.command == 'perft':
+        return 1 if runperft(args) else 0
+    elif args.command == 'selfplay':
+        runselfplay(args)
+    elif args.command == 'analyse':
+        runanalyse(args)
+    elif args.command == 'book':
+        runbook(args)
+    elif args.command == 'tablebase':
+        runtablebase(args)
+    elif args.command == 'uci':
+        runuci(args)
+    elif args.command == 'bench':
+        runbench(args)
+    elif args.command == 'tunedata':
+        return runtunedata(args)
+    elif args.command == 'tune':
+        return runtune(args)
+    elif args.command == 'serve':
+        runserve(args)
+    elif args.command == 'loadtest':
+        return runloadtest(args)
+    elif args.command == 'batchbench':
+        runbatchbench(args)
+    elif args.command == 'mate':
+        return runmate(args)
+    elif args.command == 'replay':
+        return runreplay(args)
+    else:
+        main(args.record)
+    return 0
+
+def main(record=None):
     """ Kickstart everything. Display menu after game has ended. """
     
     menu="""
@@ -698,7 +4685,7 @@ def main():
 
     try:
         while True:
-            newgame()
+            newgame(record)
 
             choice=input(menu)
 
@@ -711,5 +4698,4 @@ def main():
 
 
 if __name__ == '__main__':
-    #cProfile.run('main()')
-    main()
+    commandline()
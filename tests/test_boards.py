@@ -0,0 +1,31 @@
+import pytest
+
+import ChessMastah_0_7 as chess
+
+
+def roundtrip(boards, players, depth):
+    """ Play and take back every move on both boards, comparing as we go """
+
+    moves = sorted(players[0].get_validmoves(boards[0]))
+    assert moves == sorted(players[1].get_validmoves(boards[1]))
+    if depth == 0:
+        return
+    for start, target in moves:
+        promoteto = 'q' if players[0].ispromotion(boards[0], start, target) else None
+        for board, player in zip(boards, players):
+            player.playmove(board, start, target, promoteto)
+        assert chess.sameboard(*boards)
+        roundtrip(boards, [player.opponent for player in players], depth-1)
+        for board, player in zip(boards, players):
+            player.takeback(board, start, target, promoteto)
+        assert chess.sameboard(*boards)
+
+
+@pytest.mark.parametrize("name", sorted(chess.PERFTPOSITIONS))
+def test_backends_agree_through_moves_and_takebacks(name):
+    fen = chess.PERFTPOSITIONS[name][0]
+    (dictgame, dictplayer), (bitgame, bitplayer) = \
+        chess.headlessgame('dict', fen), chess.headlessgame('bitboard', fen)
+    roundtrip([dictgame.board, bitgame.board], [dictplayer, bitplayer], 2)
+    fresh, player = chess.headlessgame('dict', fen)
+    assert chess.sameboard(dictgame.board, fresh.board)
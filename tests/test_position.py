@@ -0,0 +1,37 @@
+import pytest
+
+import ChessMastah_0_7 as chess
+
+
+def test_moves_and_status():
+    position = chess.Position(moves=["f2f3", "e5", "g4", "Qh4#"])
+    assert position.status()["mate"]
+    assert position.legalmoves() == []
+
+
+@pytest.mark.parametrize("fen", [
+    "nonsense",
+    "4k3/8/8/8/8/8/8/8 w - - 0 1",
+    "4k3/8/8/8/8/8/8/4K3 x - - 0 1",
+    "4k3/8/8/8/8/8/8/4K3 W - - 0 1",
+])
+def test_bad_fen_raises_value_error(fen):
+    with pytest.raises(ValueError):
+        chess.Position(fen)
+
+
+@pytest.mark.parametrize("move", ["", "e4=X", "=Q", "e9", "Nzf3"])
+def test_bad_move_raises_value_error(move):
+    with pytest.raises(ValueError):
+        chess.Position().apply(move)
+
+
+def test_batchstatus_reports_a_bad_move_and_goes_on():
+    statuses = list(chess.batchstatus([None, (None, ["e4", ""]), None]))
+    assert len(statuses) == 3
+    assert "error" in statuses[1]
+    assert statuses[0] == statuses[2]
+
+
+def test_side_to_move_is_read():
+    assert chess.Position("4k3/8/8/8/8/8/8/4K3 b - - 0 1").fen().split()[1] == "b"
@@ -0,0 +1,37 @@
+import asyncio
+import types
+
+import ChessMastah_0_7 as chess
+
+
+def play(lines):
+    """ Replies of a fresh server session to lines, and the session """
+
+    server = types.SimpleNamespace(seed=0, budget={}, executor=None)
+    session = chess.ServerSession(server, 1)
+
+    async def run():
+        return [await session.command(line) for line in lines]
+
+    return asyncio.run(run()), session
+
+
+def test_moves_are_recorded_without_promotion_piece():
+    replies, session = play(["new none", "move e2e4", "move e7e5", "move g1f3"])
+    assert replies == ["ok - playing"] * 4
+    assert session.game.moves == ["e2e4", "e7e5", "g1f3"]
+
+
+def test_promotion_is_recorded_with_its_piece():
+    replies, session = play(["new none fen 8/P6k/8/8/8/8/7p/4K3 w - - 0 1",
+                             "move a7a8", "move h2h1n"])
+    assert replies[1:] == ["ok - playing", "ok - playing"]
+    assert session.game.moves == ["a7a8q", "h2h1n"]
+
+
+def test_bad_fen_is_answered_with_an_error():
+    replies, session = play(["new white fen 4k3/8/8/8/8/8/8/8 w - - 0 1",
+                             "new white fen 8/8/8/8/8/8/8/8 w - - 0 1",
+                             "new white fen nonsense", "fen"])
+    assert replies == ["error bad fen"] * 3 + \
+                      ["error no game, start one with new"]
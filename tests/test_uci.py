@@ -0,0 +1,66 @@
+import asyncio
+import io
+
+import ChessMastah_0_7 as chess
+
+
+def run(commands):
+    """ Output lines of an engine given commands, and the engine """
+
+    output = io.StringIO()
+    engine = chess.UCIEngine(output)
+
+    async def play():
+        for line in commands:
+            words = line.split()
+            result = getattr(engine, f"uci{words[0]}")(words[1:])
+            if asyncio.iscoroutine(result):
+                await result
+        # Let the last search finish instead of stopping it
+        if engine.task:
+            await engine.task
+        await engine.ucistop([])
+        engine.worker.shutdown()
+
+    asyncio.run(play())
+    return output.getvalue().splitlines(), engine
+
+
+def test_searchmoves_limits_the_root():
+    lines, engine = run(["position startpos",
+                         "go searchmoves a2a3 h2h3 depth 2"])
+    assert lines[-1].split()[1] in ("a2a3", "h2h3")
+
+
+def test_bad_go_words_are_ignored():
+    lines, engine = run(["position startpos", "go depth x frobnicate 3 depth 1"])
+    assert lines[0].startswith("info depth 1 ")
+    assert lines[-1].startswith("bestmove ")
+
+
+def test_bad_positions_keep_the_engine_running():
+    lines, engine = run(["position fen 4k3/8/8/8/8/8/8/8 w - - 0 1",
+                         "position fen nonsense",
+                         "position startpos moves e2e4 zz e7e5",
+                         "go depth 1"])
+    assert lines[0].startswith("info string bad fen")
+    assert lines[1].startswith("info string bad fen")
+    assert lines[2] == "info string illegal move zz"
+    assert engine.game.moves == ["e2e4"]
+    assert lines[-1].startswith("bestmove ")
+
+
+def test_stop_before_the_search_starts_still_gives_a_move():
+    for go in ("go infinite", "go ponder"):
+        lines, engine = run(["position startpos", go, "stop"])
+        assert lines[-1].startswith("bestmove ")
+        assert lines[-1] != "bestmove 0000"
+
+
+def test_bad_option_values_are_reported():
+    lines, engine = run(["setoption name Hash value big",
+                         "setoption name Threads value 1.5",
+                         "setoption name Hash value 8"])
+    assert lines == ["info string bad value big for Hash",
+                     "info string bad value 1.5 for Threads"]
+    assert engine.hashmb == 8